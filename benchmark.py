@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import platform
+import resource
+import shutil
+import logging
+import tempfile
+import subprocess
+from datetime import datetime
+from datetime import timedelta
+from argparse import ArgumentParser
+
+import bill
+
+def synthetic(size, seed=0):
+    # roughly a working day apart, with the mix of a real sample.json
+    random.seed(seed)
+    moment = datetime(2010, 1, 1, 9, 0)
+    for index in xrange(size):
+        if random.random() < 0.1:
+            event = {
+                'type':'payment',
+                'amount':round(random.uniform(100, 5000), 2),
+                'date':datetime.strftime(moment, bill.expression['datetime format']),
+            }
+            if random.random() < 0.3:
+                event['comment'] = u'invoice {}'.format(index)
+        else:
+            end = moment + timedelta(seconds=random.randint(600, 36000))
+            event = {
+                'type':'shift',
+                'start':datetime.strftime(moment, bill.expression['datetime format']),
+                'end':datetime.strftime(end, bill.expression['datetime format']),
+                'precision':random.choice([60, 300, 900, 1800]),
+            }
+            if random.random() < 0.3:
+                event['rate'] = random.choice([50, 80, 120, 150])
+            if random.random() < 0.4:
+                event['comment'] = u'work #{} on item {}'.format(random.choice(['dev', 'ops', 'meet']), index)
+        yield event
+        moment += timedelta(seconds=random.randint(3600, 86400))
+        
+def synthesize(path, size, seed=0):
+    # written one event at a time, so a million events never sit in memory together
+    database = open(path, 'w')
+    database.write('{\n    "history": [')
+    for index, event in enumerate(synthetic(size, seed)):
+        if index > 0:
+            database.write(',')
+        database.write('\n        ')
+        database.write(json.dumps(event, sort_keys=True))
+    database.write('\n    ], \n    "sorted": true\n}')
+    database.close()
+    
+def configure(root, projects, size):
+    config = { 'project':{} }
+    for index in xrange(projects):
+        name = 'p{:04}'.format(index)
+        path = os.path.join(root, name + '.json')
+        synthesize(path, size, index)
+        config['project'][name] = { 'db':path, 'rate':100 }
+        
+    path = os.path.join(root, 'config.json')
+    conf = open(path, 'w')
+    conf.write(json.dumps(config, sort_keys=True, indent=4))
+    conf.close()
+    return path
+    
+def measure(method, repeat):
+    best = None
+    for i in xrange(repeat):
+        began = time.time()
+        method()
+        elapsed = time.time() - began
+        if best is None or elapsed < best: best = elapsed
+    return best
+    
+def bench_projects(env):
+    print u'{:<9}, {:<9}, {:<9}, {:<9}'.format(u'projects', u'lazy', u'eager', u'saving')
+    for projects in env['projects']:
+        root = tempfile.mkdtemp(prefix='bill-')
+        try:
+            conf = { 'conf':configure(root, projects, env['size']), 'sort':False }
+            
+            def lazy():
+                b = bill.Bill(conf)
+                b.project['p0000']
+                b.unload()
+                
+            def eager():
+                b = bill.Bill(conf)
+                b.load()
+                b.unload()
+                
+            l = measure(lazy, env['repeat'])
+            e = measure(eager, env['repeat'])
+            print u'{:<9}, {:<9.4f}, {:<9.4f}, {:<9.2f}'.format(projects, l, e, e / l)
+        finally:
+            shutil.rmtree(root)
+            
+def bench_columnar(env):
+    if bill.load_numpy() is None:
+        print u'NumPy is not available'
+        return
+        
+    print u'{:<9}, {:<9}, {:<9}, {:<9}, {:<9}'.format(u'events', u'method', u'object', u'columnar', u'speedup')
+    for size in env['sizes']:
+        root = tempfile.mkdtemp(prefix='bill-')
+        try:
+            conf = { 'conf':configure(root, 1, size), 'sort':False, 'columnar':False }
+            b = bill.Bill(conf)
+            project = b.project['p0000']
+            columns = bill.Columns(project.history)
+            for method, columnar in (
+                ('report', lambda: columns.report(None, None)),
+                ('monthly', lambda: columns.monthly(None, None)),
+            ):
+                o = measure(lambda: getattr(project, { 'report':'summarize', 'monthly':'tabulate' }[method])(None, None), env['repeat'])
+                c = measure(columnar, env['repeat'])
+                print u'{:<9}, {:<9}, {:<9.4f}, {:<9.4f}, {:<9.2f}'.format(size, method, o, c, o / c)
+        finally:
+            shutil.rmtree(root)
+            
+def run(conf, project, *arguments):
+    # a fresh interpreter per run, so resident memory is that of one command
+    began = time.time()
+    devnull = open(os.devnull, 'w')
+    child = subprocess.Popen([ sys.executable, bill.__file__.replace('.pyc', '.py'), '-c', conf, '-p', project ] + list(arguments), stdout=devnull)
+    pid, status, usage = os.wait4(child.pid, 0)
+    devnull.close()
+    return time.time() - began, usage.ru_maxrss / 1024.0
+    
+def bench_formats(env):
+    print u'{:<9}, {:<9}, {:<20}, {:<9}, {:<9}'.format(u'events', u'format', u'method', u'seconds', u'rss MB')
+    for size in env['sizes']:
+        root = tempfile.mkdtemp(prefix='bill-')
+        try:
+            path = os.path.join(root, 'json.json')
+            synthesize(path, size)
+            config = {
+                'project':{
+                    'json':{ 'db':path, 'rate':100 },
+                    'binary':{ 'db':os.path.join(root, 'binary.bin'), 'rate':100, 'format':'binary' },
+                    'sqlite':{ 'db':'sqlite://' + os.path.join(root, 'sqlite.db'), 'rate':100 },
+                }
+            }
+            conf = os.path.join(root, 'config.json')
+            c = open(conf, 'w')
+            c.write(json.dumps(config, sort_keys=True, indent=4))
+            c.close()
+            for project in ('binary', 'sqlite'):
+                run(conf, project, '-v', 'warning', 'import', '-i', path)
+                
+            for project in ('json', 'binary', 'sqlite'):
+                for method in env['methods']:
+                    arguments = method.split()
+                    best = None
+                    for i in xrange(env['repeat']):
+                        result = run(conf, project, *arguments)
+                        if best is None or result[0] < best[0]: best = result
+                    print u'{:<9}, {:<9}, {:<20}, {:<9.4f}, {:<9.1f}'.format(size, project, method, best[0], best[1])
+        finally:
+            shutil.rmtree(root)
+            
+def bench_derived(env):
+    print u'{:<9}, {:<9}, {:<9}, {:<9}'.format(u'events', u'method', u'first us', u'again us')
+    for size in env['sizes']:
+        root = tempfile.mkdtemp(prefix='bill-')
+        try:
+            conf = { 'conf':configure(root, 1, size), 'sort':False, 'columnar':False }
+            b = bill.Bill(conf)
+            project = b.project['p0000']
+            stdout = sys.stdout
+            nodes = [ event.node for event in project.history ]
+            for method in ('report', 'balance'):
+                first = None
+                again = None
+                for i in xrange(env['repeat']):
+                    # freshly decoded events, so the first pass computes every derived value
+                    project.storage.replace(None, [ project.event(n) for n in nodes ])
+                    sys.stdout = open(os.devnull, 'w')
+                    try:
+                        call = { 'report':project.summarize, 'balance':project.balance }[method]
+                        began = time.time()
+                        call(None, None)
+                        elapsed = time.time() - began
+                        if first is None or elapsed < first: first = elapsed
+                        
+                        began = time.time()
+                        call(None, None)
+                        elapsed = time.time() - began
+                        if again is None or elapsed < again: again = elapsed
+                    finally:
+                        sys.stdout.close()
+                        sys.stdout = stdout
+                print u'{:<9}, {:<9}, {:<9.2f}, {:<9.2f}'.format(size, method, first / size * 1e6, again / size * 1e6)
+        finally:
+            shutil.rmtree(root)
+            
+def resident():
+    # current rather than peak resident memory, so growth can be attributed
+    statm = open('/proc/self/statm')
+    pages = int(statm.read().split()[1])
+    statm.close()
+    return pages * resource.getpagesize()
+    
+def bench_memory(env):
+    print u'{:<9}, {:<9}, {:<9}'.format(u'events', u'MB', u'bytes/event')
+    for size in env['sizes']:
+        # a fresh process per size, so memory freed by an earlier size is not reused
+        pid = os.fork()
+        if pid == 0:
+            root = tempfile.mkdtemp(prefix='bill-')
+            try:
+                conf = { 'conf':configure(root, 1, 0), 'sort':False, 'columnar':False }
+                project = bill.Bill(conf).project['p0000']
+                history = []
+                began = resident()
+                for node in synthetic(size):
+                    # decoded and derived the way a report leaves it
+                    event = project.event(node)
+                    event.value
+                    event.comment
+                    history.append(event)
+                grown = resident() - began
+                print u'{:<9}, {:<9.1f}, {:<9.1f}'.format(size, grown / 1048576.0, float(grown) / size)
+                sys.stdout.flush()
+            finally:
+                shutil.rmtree(root)
+                os._exit(0)
+        os.waitpid(pid, 0)
+        
+def legacy_flush(project, conf):
+    # the whole database as one string, the way collapse wrote it before the streaming writer
+    project.compose()
+    conf.write(project.json)
+    project.node = None
+    
+def bench_flush(env):
+    print u'{:<9}, {:<9}, {:<9}, {:<9}, {:<9}, {:<9}'.format(u'events', u'writer', u'seconds', u'peak MB', u'file MB', u'sha1')
+    for size in env['sizes']:
+        for writer in ('dumps', 'stream', 'compact'):
+            # a fresh process per writer, the peak it reaches is its own
+            pid = os.fork()
+            if pid == 0:
+                root = tempfile.mkdtemp(prefix='bill-')
+                try:
+                    conf = { 'conf':configure(root, 1, 0), 'sort':False, 'columnar':False }
+                    project = bill.Bill(conf).project['p0000']
+                    history = [ project.event(node) for node in synthetic(size) ]
+                    project.storage.replace(None, history)
+                    path = os.path.join(root, 'flush.json')
+                    best = None
+                    for i in xrange(env['repeat']):
+                        began = resident()
+                        elapsed = time.time()
+                        conf = open(path, 'wb')
+                        if writer == 'dumps':
+                            legacy_flush(project, conf)
+                        else:
+                            bill.JsonWriter(conf, writer == 'compact').write({ 'sorted':True }, ( event.node for event in project.history ))
+                        conf.close()
+                        elapsed = time.time() - elapsed
+                        if best is None or elapsed < best: best = elapsed
+                    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - began
+                    print u'{:<9}, {:<9}, {:<9.4f}, {:<9.1f}, {:<9.1f}, {:<9}'.format(
+                        size, writer, best, max(peak, 0) / 1048576.0, os.path.getsize(path) / 1048576.0,
+                        hashlib.sha1(open(path, 'rb').read()).hexdigest()[:9]
+                    )
+                    sys.stdout.flush()
+                finally:
+                    shutil.rmtree(root)
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            
+def probe(env):
+    # one operation timed in a fresh process, the parent takes peak memory from its rusage
+    conf = { 'conf':env['conf'], 'sort':False, 'quantize':'1m', 'offset':'0s' }
+    for flag in env['flags']:
+        conf[flag] = True
+        
+    b = bill.Bill(conf)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        if env['operation'] == 'load':
+            began = time.time()
+            b.load()
+            elapsed = time.time() - began
+            
+        elif env['operation'] in ('report', 'balance', 'monthly'):
+            b.load()
+            began = time.time()
+            getattr(b, env['operation'])(env['project'])
+            elapsed = time.time() - began
+            
+        elif env['operation'] == 'roundtrip':
+            began = time.time()
+            b.start(env['project'])
+            b.unload()
+            b = bill.Bill(conf)
+            b.stop(env['project'])
+            b.unload()
+            elapsed = time.time() - began
+            
+        elif env['operation'] == 'collapse':
+            # a full rewrite of the database, as after an import or a compaction
+            project = b.project[env['project']]
+            project.storage.replace(project.current, project.history)
+            began = time.time()
+            b.unload()
+            elapsed = time.time() - began
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print json.dumps({ 'seconds':elapsed })
+    
+def bench_suite(env):
+    results = {
+        'bill':hashlib.sha1(open(bill.__file__.replace('.pyc', '.py'), 'rb').read()).hexdigest(),
+        'python':platform.python_version(),
+        'platform':platform.platform(),
+        'date':datetime.now().strftime(bill.expression['datetime format']),
+        'storage':env['storage'],
+        'flags':env['flags'],
+        'results':[],
+    }
+    print u'{:<9}, {:<9}, {:<9}, {:<9}'.format(u'events', u'operation', u'seconds', u'rss MB')
+    for size in env['sizes']:
+        root = tempfile.mkdtemp(prefix='bill-')
+        try:
+            sample = os.path.join(root, 'sample.json')
+            synthesize(sample, size)
+            db = {
+                'json':sample,
+                'binary':'binary://' + os.path.join(root, 'sample.bin'),
+                'sqlite':'sqlite://' + os.path.join(root, 'sample.db'),
+                'shard':'shard://' + os.path.join(root, 'sample'),
+            }[env['storage']]
+            conf = os.path.join(root, 'config.json')
+            c = open(conf, 'w')
+            c.write(json.dumps({ 'project':{ 'sample':{ 'db':db, 'rate':100 } } }, sort_keys=True, indent=4))
+            c.close()
+            if env['storage'] != 'json':
+                run(conf, 'sample', '-v', 'warning', 'import', '-i', sample)
+                
+            # operations that write come last, each writes the database the next one reads
+            for operation in ('load', 'report', 'balance', 'monthly', 'roundtrip', 'collapse'):
+                best = None
+                for i in xrange(env['repeat']):
+                    arguments = [ sys.executable, os.path.abspath(__file__), 'probe', operation, conf, 'sample' ]
+                    for flag in env['flags']:
+                        arguments.extend([ '-g', flag ])
+                    child = subprocess.Popen(arguments, stdout=subprocess.PIPE)
+                    output = child.stdout.read()
+                    pid, status, usage = os.wait4(child.pid, 0)
+                    result = (json.loads(output)['seconds'], usage.ru_maxrss / 1024.0)
+                    if best is None or result[0] < best[0]: best = result
+                    
+                results['results'].append({ 'events':size, 'operation':operation, 'seconds':best[0], 'rss':best[1] })
+                print u'{:<9}, {:<9}, {:<9.4f}, {:<9.1f}'.format(size, operation, best[0], best[1])
+                sys.stdout.flush()
+        finally:
+            shutil.rmtree(root)
+            
+    output = open(env['output'], 'w')
+    output.write(json.dumps(results, sort_keys=True, indent=4))
+    output.close()
+    
+def bench_stress(env):
+    # every writer pays a distinct amount, a lost update shows as a missing payment or a wrong sum,
+    # readers stream the history while writers compact, an event seen twice shows as a repeated date and amount
+    print u'{:<9}, {:<9}, {:<9}, {:<9}, {:<9}, {:<9}'.format(u'storage', u'writers', u'payments', u'expected', u'seconds', u'result')
+    failed = False
+    for storage in env['storages']:
+        root = tempfile.mkdtemp(prefix='bill-')
+        try:
+            db = {
+                'json':{ 'db':os.path.join(root, 'stress.json') },
+                'journal':{ 'db':os.path.join(root, 'stress.json'), 'journal':True, 'journal limit':16 },
+                'hot':{ 'db':os.path.join(root, 'stress.json'), 'hot state':True, 'journal limit':16 },
+                'deferred':{ 'db':os.path.join(root, 'stress.json'), 'hot state':True, 'journal limit':4 },
+                'binary':{ 'db':'binary://' + os.path.join(root, 'stress.bin') },
+                'sqlite':{ 'db':'sqlite://' + os.path.join(root, 'stress.db') },
+                'shard':{ 'db':'shard://' + os.path.join(root, 'stress') },
+            }[storage]
+            db['rate'] = 100
+            path = os.path.join(root, 'config.json')
+            conf = open(path, 'w')
+            conf.write(json.dumps({ 'project':{ 'stress':db } }, sort_keys=True, indent=4))
+            conf.close()
+            
+            began = time.time()
+            children = []
+            for writer in xrange(env['writers']):
+                pid = os.fork()
+                if pid == 0:
+                    status = 0
+                    try:
+                        for index in xrange(env['count']):
+                            date = (datetime(2014, 1, 1) + timedelta(days=index)).strftime(bill.expression['date format'])
+                            b = bill.Bill({ 'conf':path, 'sort':False, 'amount':float(writer + 1), 'date':date })
+                            if not b.pay('stress'):
+                                status = 1
+                            b.unload()
+                    except Exception:
+                        logging.exception(u'Writer %d failed', writer)
+                        status = 1
+                    finally:
+                        os._exit(status)
+                children.append(pid)
+                
+            for reader in xrange(env['readers']):
+                pid = os.fork()
+                if pid == 0:
+                    status = 0
+                    try:
+                        random.seed(reader)
+                        for index in xrange(env['count']):
+                            # the history is opened, left for a commit to land, and only then streamed
+                            project = bill.Bill({ 'conf':path, 'sort':False, 'stream':True }).project['stress']
+                            time.sleep(random.uniform(0, 0.05))
+                            seen = [ (event.date, event.value) for event in project.storage.stream() if isinstance(event, bill.Payment) ]
+                            if len(seen) != len(set(seen)):
+                                logging.error(u'Reader %d saw %d events twice', reader, len(seen) - len(set(seen)))
+                                status = 1
+                    except Exception:
+                        logging.exception(u'Reader %d failed', reader)
+                        status = 1
+                    finally:
+                        os._exit(status)
+                children.append(pid)
+                
+            status = 0
+            for pid in children:
+                status |= os.waitpid(pid, 0)[1]
+            elapsed = time.time() - began
+            
+            payments = [ event for event in bill.Bill({ 'conf':path, 'sort':False }).project['stress'].history if isinstance(event, bill.Payment) ]
+            expected = env['count'] * env['writers'] * (env['writers'] + 1) / 2
+            total = int(round(sum(event.value for event in payments)))
+            result = (status == 0 and len(payments) == env['writers'] * env['count'] and total == expected) and u'ok' or u'FAILED'
+            failed = failed or result != u'ok'
+            print u'{:<9}, {:<9}, {:<9}, {:<9}, {:<9.2f}, {:<9}'.format(storage, env['writers'], len(payments), env['writers'] * env['count'], elapsed, result)
+            sys.stdout.flush()
+        finally:
+            shutil.rmtree(root)
+    if failed:
+        sys.exit(1)
+        
+def legacy_round(time, quantizer):
+    # the float seconds rounding bill.py used before microsecond arithmetic, kept as the reference
+    stamp = (time - bill.expression['epoch']).total_seconds()
+    quant = quantizer.total_seconds()
+    result = int(stamp / quant)
+    remain = stamp - result * quant
+    if int(round(remain/quant)): result += 1
+    return datetime.utcfromtimestamp(result * quant)
+    
+def bench_quantize(env):
+    # every mismatch with the float rounding must be a zero precision, where it raised,
+    # or a stamp within a few microseconds of a half precision, where float seconds can not tell the sides apart,
+    # which grows with the stamp, past the year 2200 a double no longer holds every microsecond
+    random.seed(env['seed'])
+    print u'{:<9}, {:<9}, {:<9}, {:<9}, {:<9}, {:<9}, {:<9}, {:<9}'.format(u'precision', u'stamps', u'zero', u'float', u'wrong', u'legacy', u'exact', u'batch')
+    failed = False
+    for text in env['precisions']:
+        quantizer = bill.parse_time_delta(text)
+        quant = bill.delta_to_microseconds(quantizer)
+        step = max(abs(quant), 1)
+        stamps = []
+        for index in xrange(env['size']):
+            stamp = random.randint(-2**40, 2**57)
+            kind = index % 4
+            if kind == 1:
+                stamp = stamp // step * step + random.randint(-2, 2)
+            elif kind == 2:
+                stamp = stamp // step * step + step // 2 + random.randint(-2, 2)
+            elif kind == 3:
+                stamp = -stamp // 2**12
+            stamps.append(stamp)
+        times = [ bill.microseconds_to_datetime(stamp) for stamp in stamps ]
+        
+        count = { 'zero':0, 'float':0, 'wrong':0 }
+        exact = [ bill.round_microseconds(stamp, quant) for stamp in stamps ]
+        for stamp, time, rounded in zip(stamps, times, exact):
+            if bill.round_microseconds(rounded, quant) != rounded:
+                count['wrong'] += 1
+                continue
+            try:
+                expected = bill.datetime_to_microseconds(legacy_round(time, quantizer))
+            except ZeroDivisionError:
+                count['zero'] += 1
+                continue
+            if expected != rounded:
+                # the stamp sits on a half precision, or on a whole one when the precision is negative,
+                # give or take what a double holds of the seconds
+                if abs(expected - rounded) <= 2 * step and min(stamp * 2 % step, -stamp * 2 % step) <= 8 + (abs(stamp) >> 49):
+                    count['float'] += 1
+                else:
+                    count['wrong'] += 1
+                    
+        if bill.round_stamps(stamps, quant) != exact:
+            count['wrong'] += 1
+            
+        l = quant and measure(lambda: [ legacy_round(time, quantizer) for time in times ], env['repeat']) or float('nan')
+        e = measure(lambda: [ bill.round_datetime_to_timedelta(time, quantizer) for time in times ], env['repeat'])
+        b = measure(lambda: bill.round_stamps(stamps, quant), env['repeat'])
+        failed = failed or count['wrong'] > 0
+        print u'{:<9}, {:<9}, {:<9}, {:<9}, {:<9}, {:<9.4f}, {:<9.4f}, {:<9.4f}'.format(text, len(stamps), count['zero'], count['float'], count['wrong'], l, e, b)
+        sys.stdout.flush()
+    if failed:
+        sys.exit(1)
+        
+def bench_compare(env):
+    node = []
+    for path in (env['base'], env['head']):
+        c = open(path, 'r')
+        node.append(dict(((r['events'], r['operation']), r) for r in json.load(c)['results']))
+        c.close()
+        
+    print u'{:<9}, {:<9}, {:<9}, {:<9}, {:<9}, {:<9}, {:<9}'.format(u'events', u'operation', u'base s', u'head s', u'ratio', u'base MB', u'head MB')
+    for key in sorted(set(node[0]) & set(node[1])):
+        base = node[0][key]
+        head = node[1][key]
+        ratio = head['seconds'] / base['seconds'] if base['seconds'] > 0 else float('nan')
+        print u'{:<9}, {:<9}, {:<9.4f}, {:<9.4f}, {:<9.2f}, {:<9.1f}, {:<9.1f}{}'.format(
+            key[0], key[1], base['seconds'], head['seconds'], ratio, base['rss'], head['rss'],
+            u' *' if ratio > env['threshold'] or head['rss'] > base['rss'] * env['threshold'] else u''
+        )
+        
+def decode_cli():
+    env = {}
+    p = ArgumentParser()
+    p.add_argument('-r', '--repeat', metavar='COUNT', type=int, dest='repeat', default=3,   help='repetitions, best time is reported [default: %(default)s]')
+    p.add_argument('-n', '--size',   metavar='COUNT', type=int, dest='size',   default=1000, help='events per synthetic project [default: %(default)s]')
+    
+    s = p.add_subparsers(dest='action')
+    c = s.add_parser( 'projects', help='startup time of lazy versus eager project loading')
+    c.add_argument('projects', metavar='COUNT', type=int, nargs='*', default=[1, 4, 16, 64], help='number of configured projects')
+    
+    c = s.add_parser( 'columnar', help='object versus columnar report aggregation')
+    c.add_argument('sizes', metavar='COUNT', type=int, nargs='*', default=[1000, 100000], help='number of events')
+    
+    c = s.add_parser( 'derived', help='per event cost of report and balance, on fresh events and once more on the same events')
+    c.add_argument('sizes', metavar='COUNT', type=int, nargs='*', default=[1000, 100000], help='number of events')
+    
+    c = s.add_parser( 'memory', help='resident bytes per decoded event')
+    c.add_argument('sizes', metavar='COUNT', type=int, nargs='*', default=[100000, 1000000], help='number of events')
+    
+    c = s.add_parser( 'suite', help='time and peak memory of every operation, written to a results file')
+    c.add_argument('-o', '--output',  metavar='PATH', dest='output',  default='benchmark.json', help='results file [default: %(default)s]')
+    c.add_argument('-s', '--storage', metavar='KIND', dest='storage', default='json', choices=['json', 'binary', 'sqlite', 'shard'], help='database storage [default: %(default)s]')
+    c.add_argument('-g', '--flag',    metavar='FLAG', dest='flags',   action='append', default=[], choices=['columnar', 'stream'], help='bill.py global flag to set')
+    c.add_argument('sizes', metavar='COUNT', type=int, nargs='*', default=[1000, 100000, 1000000], help='number of events')
+    
+    c = s.add_parser( 'flush', help='time and peak memory of writing a database as one string, streamed and streamed compact')
+    c.add_argument('sizes', metavar='COUNT', type=int, nargs='*', default=[100000, 1000000], help='number of events')
+    
+    c = s.add_parser( 'probe', help='run one suite operation in this process')
+    c.add_argument('-g', '--flag',    metavar='FLAG', dest='flags',   action='append', default=[], choices=['columnar', 'stream'], help='bill.py global flag to set')
+    c.add_argument('operation', choices=['load', 'report', 'balance', 'monthly', 'roundtrip', 'collapse'])
+    c.add_argument('conf', metavar='PATH')
+    c.add_argument('project')
+    
+    c = s.add_parser( 'stress', help='concurrent writer processes paying into one project, checked for lost updates')
+    c.add_argument('-w', '--writers', metavar='COUNT', type=int, dest='writers', default=8,  help='concurrent processes [default: %(default)s]')
+    c.add_argument('-k', '--count',   metavar='COUNT', type=int, dest='count',   default=25, help='payments per process [default: %(default)s]')
+    c.add_argument('-e', '--readers', metavar='COUNT', type=int, dest='readers', default=2,  help='concurrent streaming readers [default: %(default)s]')
+    c.add_argument('storages', metavar='STORAGE', nargs='*', default=['json', 'journal', 'hot', 'deferred', 'binary', 'sqlite', 'shard'], help='json, journal, hot, deferred, binary, sqlite or shard [default: all of them]')
+    
+    c = s.add_parser( 'quantize', help='microsecond rounding checked against the float rounding, with legacy, exact and batch timings')
+    c.add_argument('-s', '--seed', metavar='SEED', type=int, dest='seed', default=0, help='random seed [default: %(default)s]')
+    c.add_argument('precisions', metavar='DELTA', nargs='*', default=['', '1s', '7s', '1m', '15m', '1h', '1h30m', '8h', '24h', '17m3s', '1m-', '15m-'], help='precisions as bill.py parses them [default: zero to a day, some negative]')
+    
+    c = s.add_parser( 'compare', help='compare two suite results files')
+    c.add_argument('-t', '--threshold', metavar='RATIO', type=float, dest='threshold', default=1.1, help='mark ratios above this [default: %(default)s]')
+    c.add_argument('base', metavar='PATH')
+    c.add_argument('head', metavar='PATH')
+    
+    c = s.add_parser( 'formats', help='load time and resident memory of the JSON, binary and SQLite databases')
+    c.add_argument('-m', '--method', metavar='ACTION', dest='methods', action='append', help='bill.py action to time [default: report, --columnar report, report -f 2014-03-01, balance, --stream balance]')
+    c.add_argument('sizes', metavar='COUNT', type=int, nargs='*', default=[1000, 100000], help='number of events')
+    
+    for k,v in vars(p.parse_args()).iteritems():
+        if v is not None:
+            env[k] = v
+    return env
+    
+def main():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.WARNING)
+    env = decode_cli()
+    if env['action'] == 'projects':
+        bench_projects(env)
+        
+    if env['action'] == 'columnar':
+        bench_columnar(env)
+        
+    if env['action'] == 'derived':
+        bench_derived(env)
+        
+    if env['action'] == 'memory':
+        bench_memory(env)
+        
+    if env['action'] == 'flush':
+        bench_flush(env)
+        
+    if env['action'] == 'suite':
+        bench_suite(env)
+        
+    if env['action'] == 'probe':
+        probe(env)
+        
+    if env['action'] == 'compare':
+        bench_compare(env)
+        
+    if env['action'] == 'stress':
+        bench_stress(env)
+        
+    if env['action'] == 'quantize':
+        bench_quantize(env)
+        
+    if env['action'] == 'formats':
+        if 'methods' not in env:
+            env['methods'] = [ 'report', '--columnar report', 'report -f 2014-03-01', 'balance', '--stream balance' ]
+        bench_formats(env)
+        
+if __name__ == '__main__':
+    main()
+    
\ No newline at end of file
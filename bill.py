@@ -7,12 +7,36 @@ import re
 import logging
 import json
 import math
+import mmap
+import struct
+import bisect
 import hashlib
+import sqlite3
+import gc
+import time
+import cProfile
+import resource
+import fnmatch
+import fcntl
+import random
+import tempfile
+import socket
+import select
+import signal
+import csv
+import shlex
+import marshal
+from contextlib import contextmanager
+from itertools import islice
+from array import array
 from StringIO import StringIO
 from datetime import datetime
 from datetime import timedelta
 from argparse import ArgumentParser
-from subprocess import Popen, PIPE
+
+# optional, load_numpy imports it on first use
+numpy = None
+numpy_loaded = False
 
 log_levels = {
     'debug': logging.DEBUG,
@@ -24,16 +48,187 @@ log_levels = {
 expression = {
     'csv monthly record header':u'{:<4}, {:<5}, {:<9}, {:<10}, {:<9}',
     'csv monthly record pattern':u'{:<4}, {:<5}, {:<9}, {:<10.2f}, {:<10.2f}',    
+    'csv project monthly record header':u'{:<12}, {:<4}, {:<5}, {:<9}, {:<10}, {:<9}',
+    'csv project monthly record pattern':u'{:<12}, {:<4}, {:<5}, {:<9}, {:<10.2f}, {:<10.2f}',
+    'csv project record header':u'{:<12}, {:<6}, {:<8}, {:<9}, {:<10}, {:<10}, {:<9}',
+    'csv project record pattern':u'{:<12}, {:<6}, {:<8}, {:<9}, {:<10.2f}, {:<10.2f}, {:<10.2f}',
     'csv record header':u'{:<9},{:<17},{:<17},{:<9},{:<9},{:<9},{}',
     'csv record pattern':u'{:<9},{:<17},{:<17},{:<9},{:<10.2f},{:<10.2f},{}',
     'current record pattern':u'Current shift started at {:<16} and has been running for {:<16}',
     'datetime format':'%Y-%m-%dT%H:%M:%S.%f',
     'csv datetime format':'%Y-%m-%d %H:%M',
+    'profile header':u'{:<12} {:>7} {:>10} {:>10} {:>10} {:>10}\n',
+    'profile pattern':u'{:<12} {:>7} {:>10.4f} {:>10.4f} {:>10} {:>10}\n',
+    'profile calls header':u'{:<28} {:>10} {:>10}\n',
+    'profile calls pattern':u'{:<28} {:>10} {:>10.4f}\n',
     'date format':'%Y-%m-%d',
+    'project glob':re.compile('[*?\[]'),
+    'grand total':u'*',
+    'daemon socket':'~/.bill/bill.sock',
+    'tsv separator':re.compile('[\t\r\n]'),
+    'batch actions':('start', 'stop', 'pay', 'import'),
+    'daemon actions':('start', 'stop', 'pay', 'report', 'balance', 'monthly', 'aggregate', 'export', 'import'),
+    'status actions':('import', 'batch'),
     'time delta':{
         'pattern':re.compile('(?:(?P<hours>[0-9]+)h)?(?:(?P<minutes>[0-9]+)m)?(?:(?P<seconds>[0-9]+)s)?(?P<sign>-)?'),
     },
     'epoch': datetime.utcfromtimestamp(0),
+    'url':re.compile('^(?P<scheme>[a-z]+)://(?P<path>.*)$'),
+    'json whitespace':re.compile('[ \t\n\r]*'),
+    'json sorted tail':re.compile('"sorted"\s*:\s*true\s*\}\s*$'),
+}
+binary_format = {
+    'magic':'BILL',
+    'version':1,
+    # magic, version, flags, record count, string table offset
+    'header':struct.Struct('<4sHHQQ'),
+    # start, end, precision, rate, amount, type, comment offset, comment length
+    'record':struct.Struct('<qqiddBII3x'),
+    'type':{ 'shift':0, 'payment':1, 'none':255 },
+    'flag':{ 'sorted':1, 'current':2 },
+    'null':{ 'time':-2**63, 'precision':-2**31, 'string':2**32 - 1 },
+}
+prefix_format = {
+    'magic':'BILP',
+    'version':1,
+    # magic, version, integer size, snapshot size, snapshot mtime, journal records, event count, tree capacity, slack
+    'header':struct.Struct('<4sHHqdqqqq'),
+    # one entry per event in history order
+    'event':( ('order', 'l'), ('key', 'l'), ('late', 'l'), ('kind', 'b'), ('value', 'd'), ('duration', 'l') ),
+    # running totals before each event, one more entry than there are events
+    'running':( ('shifts', 'l'), ('payments', 'l'), ('worked', 'l'), ('labour', 'd'), ('deposit', 'd'), ('balance', 'd') ),
+    # min and max segment trees over the event key and the event end
+    'tree':( ('lowest', 'l'), ('highest', 'l') ),
+    'null':{ 'lowest':2**63 - 1, 'highest':-2**63 },
+}
+cache_format = {
+    'magic':'BILC',
+    'version':1,
+    # history is kept as one list per column, in the order decode_event takes them
+    'columns':('type', 'start', 'end', 'precision', 'rate', 'amount', 'comment'),
+}
+digest_format = {
+    'magic':'BILH',
+    'version':1,
+    # magic, version, integer size, database version, digest count, table capacity
+    'header':struct.Struct('<4sHHqqq'),
+    'capacity':1 << 10,
+    # a journal record is the database version a commit wrote and the count of digests that follow it
+    'record':struct.Struct('<qq'),
+    'digest':'<{}Q',
+}
+import_format = {
+    # bulk imports by file extension, anything else is a JSON database
+    'type':{ '.csv':'csv', '.jsonl':'jsonl', '.ndjson':'jsonl' },
+    'dates':('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d %H:%M', '%Y-%m-%d'),
+    'precision':60,
+    'budget':100000,
+}
+shard_format = {
+    # shard file name for the period an event falls in
+    'period':{ 'month':'%Y-%m', 'year':'%Y' },
+    'manifest':'manifest.json',
+    'lock':'lock',
+    'suffix':'.json',
+}
+sqlite_format = {
+    'schema':'''
+        CREATE TABLE IF NOT EXISTS event (
+            id INTEGER PRIMARY KEY,
+            project TEXT NOT NULL,
+            type INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            stop INTEGER,
+            precision INTEGER,
+            rate REAL,
+            amount REAL,
+            comment TEXT,
+            round_start INTEGER,
+            round_end INTEGER,
+            value REAL
+        );
+        CREATE INDEX IF NOT EXISTS event_project_start ON event (project, start);
+        CREATE TABLE IF NOT EXISTS running (
+            project TEXT PRIMARY KEY,
+            start INTEGER NOT NULL,
+            precision INTEGER,
+            rate REAL,
+            comment TEXT
+        );
+        CREATE TABLE IF NOT EXISTS version (
+            project TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+    ''',
+    'aggregate':'''
+        SELECT
+            COALESCE(SUM(type = 0), 0),
+            COALESCE(SUM(type = 1), 0),
+            MIN(CASE WHEN type = 0 THEN round_start ELSE start END),
+            MAX(CASE WHEN type = 0 THEN round_end ELSE start END),
+            COALESCE(SUM(CASE WHEN type = 0 THEN round_end - round_start ELSE 0 END), 0)
+        FROM event WHERE {}
+    ''',
+    'ledger':'''
+        SELECT
+            CAST(strftime('%Y', start / 1000000, 'unixepoch') AS INTEGER),
+            CAST(strftime('%m', start / 1000000, 'unixepoch') AS INTEGER),
+            type,
+            COALESCE(stop - start, 0),
+            value
+        FROM event WHERE {}
+        ORDER BY start, id
+    ''',
+}
+
+aggregate_format = {
+    # groups a key yields per year of history, and whether history arrives ordered by it
+    'key':{
+        'day':(366, True),
+        'week':(53, True),
+        'month':(12, True),
+        'year':(1, True),
+        'rate':(None, False),
+        'tag':(None, False),
+    },
+    'metric':('hours', 'value', 'count', 'balance'),
+    # a leading ordered key with at least this many groups a year is grouped run by run, anything else in one table
+    'runs':12,
+    'tag':re.compile(u'#(\w+)', re.UNICODE),
+    'separator':u', ',
+    'header':{ 'key':u'{:<10}', 'hours':u'{:<9}', 'value':u'{:<10}', 'count':u'{:<7}', 'balance':u'{:<9}' },
+    'pattern':{ 'key':u'{:<10}', 'hours':u'{:<9}', 'value':u'{:<10.2f}', 'count':u'{:<7}', 'balance':u'{:<10.2f}' },
+}
+
+render_format = {
+    'balance':{
+        'fields':(u'type', u'start', u'end', u'duration', u'amount', u'balance', u'comment'),
+        'header':'csv record header',
+        'pattern':'csv record pattern',
+    },
+    'monthly':{
+        'fields':(u'year', u'month', u'duration', u'amount', u'balance'),
+        'header':'csv monthly record header',
+        'pattern':'csv monthly record pattern',
+    },
+    'project':{
+        'fields':(u'project', u'shifts', u'payments', u'duration', u'labour', u'deposit', u'balance'),
+        'header':'csv project record header',
+        'pattern':'csv project record pattern',
+    },
+    'project monthly':{
+        'fields':(u'project', u'year', u'month', u'duration', u'amount', u'balance'),
+        'header':'csv project monthly record header',
+        'pattern':'csv project monthly record pattern',
+    },
+    'buffer':1 << 16,
+    'dates':1 << 16,
+}
+json_format = {
+    'pretty':{ 'indent':4, 'separators':(', ', ': '), 'sort_keys':True },
+    'compact':{ 'indent':None, 'separators':(',', ':'), 'sort_keys':False },
+    'chunk':1 << 16,
+    'batch':1 << 10,
 }
 
 class Bill(object):
@@ -42,29 +237,32 @@ class Bill(object):
         self.env = env
         self.config = None
         self.project = None
+        self.pending = []
+        self.batched = False
         
         # load the JSON config file
         if self.env['conf']:
-            path = os.path.realpath(os.path.expanduser(os.path.expandvars(self.env['conf'])))
+            path = expand_conf(self.env['conf'])
             if os.path.exists(path):
-                try:
-                    conf = open(path, 'r')
-                    stream = StringIO(conf.read())
-                    conf.close()
-                except IOError as ioerr:
-                    self.log.warning(u'Failed to load config file %s', path)
-                    self.log.debug(ioerr)
-                else:
+                with profiler.phase('config'):
                     try:
-                        self.config = json.load(stream)
-                    except ValueError, e:
-                        self.log.warning(u'Failed to decode JSON document %s', path)
-                        self.log.debug(u'Exception raised %s', unicode(e))
+                        conf = open(path, 'r')
+                        stream = StringIO(conf.read())
+                        conf.close()
+                    except IOError as ioerr:
+                        self.log.warning(u'Failed to load config file %s', path)
+                        self.log.debug(ioerr)
                     else:
-                        self.project = {}
-                        for k,v in self.config['project'].iteritems():
-                            v['name'] = k
-                            self.project[k] = ProjectBill(self, v)
+                        try:
+                            self.config = json.load(stream)
+                        except ValueError, e:
+                            self.log.warning(u'Failed to decode JSON document %s', path)
+                            self.log.debug(u'Exception raised %s', unicode(e))
+                        else:
+                            self.project = ProjectMap()
+                            for k,v in self.config['project'].iteritems():
+                                v['name'] = k
+                                self.project[k] = ProjectBill(self, v)
             else:
                 self.log.warning(u'Could not find configuation file %s', self.env['conf'])
                 
@@ -73,20 +271,26 @@ class Bill(object):
         return self.config is not None
         
     def load(self):
+        # projects are otherwise expanded on first access through self.project
         for project in self.project.values():
-            project.expand()
-            
+            if not project.loaded:
+                project.expand()
+                
     def unload(self):
-        for project in self.project.values():
-            project.collapse()
+        loaded = self.project.loaded
+        self.log.debug(u'%d of %d projects were loaded', len(loaded), len(self.project))
+        for project in loaded:
+            # changes were committed already, what is left is a sort or a cache someone else may have superseded
+            if not project.collapse():
+                self.log.debug(u'Dropped a stale rewrite of project %s', project.name)
             
     def start(self, project):
         if project in self.project:
-            self.project[project].start()
+            return self.commit(project, lambda bill: bill.start())
             
     def stop(self, project):
-        for project in self.project.values():
-            self.project[project].stop()
+        if project in self.project:
+            return self.commit(project, lambda bill: bill.stop())
             
     def report(self, project):
         start = None
@@ -97,7 +301,26 @@ class Bill(object):
         if 'to' in self.env:
             end = datetime.strptime(self.env['to'], expression['date format'])
             
-        if project in self.project:
+        names = self.match(project)
+        if names is not None:
+            with profiler.phase('aggregate'):
+                results = self.consolidate('report', names, start, end)
+                
+            with profiler.phase('print'):
+                grand = None
+                for name, total, running in results:
+                    print_report(name, total)
+                    if running is not None:
+                        print_running(*running)
+                    print ''
+                    grand = merge_report(grand, total)
+                    
+                if grand is not None:
+                    print_report(expression['grand total'], grand)
+                    
+        elif project in self.project:
+            if self.pending:
+                self.settle()
             self.project[project].report(start, end)
             
     def balance(self, project):
@@ -109,7 +332,26 @@ class Bill(object):
         if 'to' in self.env:
             end = datetime.strptime(self.env['to'], expression['date format'])
             
-        if project in self.project:
+        names = self.match(project)
+        if names is not None:
+            # a consolidated balance is one line per project, shipping every event back from the workers would defeat them
+            with profiler.phase('aggregate'):
+                results = self.consolidate('balance', names, start, end)
+                
+            with profiler.phase('print'):
+                rows = []
+                grand = None
+                for name, total, running in results:
+                    rows.append(project_balance_row(name, total))
+                    grand = merge_report(grand, total)
+                    
+                if grand is not None:
+                    rows.append(project_balance_row(expression['grand total'], grand))
+                Renderer(self.env).render('project', rows)
+                    
+        elif project in self.project:
+            if self.pending:
+                self.settle()
             self.project[project].balance(start, end)
             
     def monthly(self, project):
@@ -121,9 +363,82 @@ class Bill(object):
         if 'to' in self.env:
             end = datetime.strptime(self.env['to'], expression['date format'])
             
-        if project in self.project:
+        names = self.match(project)
+        if names is not None:
+            with profiler.phase('aggregate'):
+                results = self.consolidate('monthly', names, start, end)
+                
+            with profiler.phase('print'):
+                rows = []
+                grand = None
+                for name, total, running in results:
+                    rows.extend(project_monthly_rows(name, total))
+                    grand = merge_monthly(grand, name, total)
+                    
+                if grand is not None:
+                    rows.extend(project_monthly_rows(expression['grand total'], grand))
+                Renderer(self.env).render('project monthly', rows)
+                    
+        elif project in self.project:
+            if self.pending:
+                self.settle()
             self.project[project].monthly(start, end)
             
+    def group(self, project):
+        start = None
+        if 'from' in self.env:
+            start = datetime.strptime(self.env['from'], expression['date format'])
+            
+        end = None
+        if 'to' in self.env:
+            end = datetime.strptime(self.env['to'], expression['date format'])
+            
+        if project in self.project:
+            if self.pending:
+                self.settle()
+            self.project[project].group(start, end, self.env['group'], self.env['metric'])
+            
+    def match(self, project):
+        # None unless the command addresses several projects at once
+        if 'all' in self.env and self.env['all']:
+            return sorted(self.project.keys())
+            
+        if project is not None and expression['project glob'].search(project):
+            names = sorted(fnmatch.filter(self.project.keys(), project))
+            if not names:
+                self.log.warning(u'No project matches %s', project)
+            return names
+            
+        return None
+        
+    def consolidate(self, action, names, start, end):
+        # each project is loaded and aggregated in its own process, only the totals come back
+        if self.pending:
+            self.settle()
+            
+        tasks = [ (self.env, name, action, start, end) for name in names ]
+        jobs = min(self.jobs, len(tasks))
+        if jobs > 1:
+            import multiprocessing
+            self.log.debug(u'Aggregating %d projects in %d processes', len(tasks), jobs)
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(aggregate_project, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ aggregate_project(task) for task in tasks ]
+        return results
+        
+    @property
+    def jobs(self):
+        if 'jobs' in self.env and self.env['jobs'] > 0:
+            return self.env['jobs']
+        else:
+            import multiprocessing
+            return multiprocessing.cpu_count()
+            
     def pay(self, project):
         amount = None
         if 'amount' in self.env:
@@ -134,8 +449,195 @@ class Bill(object):
             date = datetime.strptime(self.env['date'], expression['date format'])
             
         if project in self.project:
-            self.project[project].pay(amount, date)
+            return self.commit(project, lambda bill: bill.pay(amount, date))
+            
+    def export(self, project):
+        if project in self.project:
+            if self.pending:
+                self.settle()
+            self.project[project].export(self.env['output'])
+            
+    def ingest(self, project):
+        kind = 'type' in self.env and self.env['type'] or None
+        if kind is None:
+            kind = import_format['type'].get(os.path.splitext(self.env['input'])[1].lower(), 'json')
+            
+        if project in self.project:
+            return self.commit(project, lambda bill: bill.ingest(self.env['input'], kind))
+            
+    def migrate(self, project):
+        if project in self.project:
+            self.project[project].migrate(self.env['output'], 'shard' in self.env and self.env['shard'] or None)
+            
+    def commit(self, project, change):
+        # a change that was refused has nothing to write
+        try:
+            if change(self.project[project]) is False:
+                return False
+        except sqlite3.Error as err:
+            self.log.error(u'Failed to change project %s', project)
+            self.log.debug(u'Exception raised %s', unicode(err))
+            return False
+        self.pending.append((project, self.env, change))
+        
+        # a daemon batches its writes and settles them once requests quiet down
+        if self.batched:
+            return True
+        return self.settle()
+        
+    def settle(self):
+        # writers do not wait for each other, one that lost the race redoes its changes over what the winner wrote
+        result = True
+        env = self.env
+        names = []
+        for project, change_env, change in self.pending:
+            if project not in names:
+                names.append(project)
+                
+        for project in names:
+            changes = [ (change_env, change) for name, change_env, change in self.pending if name == project ]
+            for attempt in range(self.retries):
+                # a database still locked once its timeout ran out is retried like a conflicting write
+                try:
+                    if attempt:
+                        self.log.debug(u'Project %s was written concurrently, retrying', project)
+                        time.sleep(random.uniform(0, 0.005 * 2 ** min(attempt - 1, 8)))
+                        self.project[project].expand()
+                        for change_env, change in changes:
+                            self.env = change_env
+                            change(self.project[project])
+                        self.env = env
+                        
+                    if self.project[project].collapse():
+                        break
+                except sqlite3.Error as err:
+                    self.env = env
+                    self.log.debug(u'Exception raised %s', unicode(err))
+            else:
+                self.log.error(u'Giving up on project %s after %d conflicting writes', project, self.retries)
+                result = False
+        self.pending = []
+        return result
+        
+    def batch(self):
+        # every line is applied in memory, each project is written once after the last line went through
+        env = self.env
+        result = True
+        try:
+            if env['input'] == '-':
+                lines = sys.stdin.readlines()
+            else:
+                conf = open(env['input'], 'r')
+                lines = conf.readlines()
+                conf.close()
+        except IOError as ioerr:
+            self.log.error(u'Failed to load batch %s', env['input'])
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+            return False
+            
+        # lines take the configuration and the project from the batch, unless they set their own
+        options = [ '-c', env['conf'], '-p', env['project'], '-v', env['verbosity'] ]
+        parser = command_parser()
+        self.batched = True
+        applied = 0
+        for number, line in enumerate(lines, 1):
+            try:
+                argv = shlex.split(line, comments=True)
+                if argv:
+                    self.env = decode_cli(options + argv, parser)
+                    if self.env['action'] not in expression['batch actions']:
+                        self.log.error(u'Line %d of the batch is a %s, only %s can be batched', number, self.env['action'], u', '.join(expression['batch actions']))
+                        result = False
+                    elif self.execute() is not True:
+                        self.log.error(u'Line %d of the batch failed: %s', number, line.strip().decode('utf-8', 'replace'))
+                        result = False
+                    else:
+                        applied += 1
+            except ValueError as valerr:
+                self.log.error(u'Failed to parse line %d of the batch', number)
+                self.log.debug(u'Exception raised %s', unicode(valerr))
+                result = False
+            except SystemExit:
+                # argparse already said what was wrong with the line
+                result = False
+            if not result:
+                break
+        self.env = env
+        self.batched = False
+        
+        if result:
+            result = self.settle()
+            self.log.info(u'Applied %d batched commands', applied)
+        else:
+            # projects are read again, nothing the batch did in memory is written
+            self.log.error(u'Rolling back %d batched commands', applied)
+            self.pending = []
+            for project in self.project.loaded:
+                project.expand()
+        return result
+        
+    def refresh(self):
+        # a resident bill picks up what other processes wrote, unless it has changes of its own waiting
+        waiting = [ project for project, change_env, change in self.pending ]
+        for project in self.project.loaded:
+            if project.name not in waiting and project.storage is not None and project.storage.stale():
+                self.log.debug(u'Reloading project %s', project.name)
+                project.expand()
+                
+    def execute(self):
+        # the result of a command that writes, False when it was refused or could not be written
+        result = None
+        if self.env['action'] == 'start':
+            result = self.start(self.env['project'])
+        
+        if self.env['action'] == 'stop':
+            result = self.stop(self.env['project'])
+            
+        if self.env['action'] == 'pay':
+            result = self.pay(self.env['project'])
+            
+        if self.env['action'] == 'report':
+            self.report(self.env['project'])
+            
+        if self.env['action'] == 'balance':
+            self.balance(self.env['project'])
+            
+        if self.env['action'] == 'monthly':
+            self.monthly(self.env['project'])
+            
+        if self.env['action'] == 'aggregate':
+            self.group(self.env['project'])
             
+        if self.env['action'] == 'export':
+            self.export(self.env['project'])
+            
+        if self.env['action'] == 'import':
+            result = self.ingest(self.env['project'])
+            
+        if self.env['action'] == 'migrate':
+            self.migrate(self.env['project'])
+            
+        if self.env['action'] == 'batch':
+            result = self.batch()
+        return result
+            
+    @property
+    def retries(self):
+        return ('write retries' in self.config and self.config['write retries']) or 32
+            
+
+
+class ProjectMap(dict):
+    def __getitem__(self, key):
+        project = dict.__getitem__(self, key)
+        if not project.loaded:
+            project.expand()
+        return project
+        
+    @property
+    def loaded(self):
+        return [ project for project in self.values() if project.loaded ]
+        
 
 
 class ProjectBill(object):
@@ -144,87 +646,180 @@ class ProjectBill(object):
         self.bill = bill
         self.config = config
         self.node = None
-        self._current = None
-        self._history = None
-        self.volatile = False
+        self.storage = None
+        self.loaded = False
         
-    def varify_directory(self, path):
+    def expand(self):
+        self.loaded = True
+        self.storage = None
+        if self.config and 'db' in self.config:
+            scheme, path = self.location
+            if scheme in ('file', 'json', 'binary'):
+                self.storage = FileStorage(self)
+                
+            elif scheme == 'shard':
+                self.storage = ShardStorage(self)
+                
+            elif scheme == 'sqlite':
+                self.storage = SqliteStorage(self)
+                
+            else:
+                self.log.error(u'Unknown storage scheme %s for project %s', scheme, self.name)
+                
+            if self.storage is not None:
+                self.storage.open()
+                
+    def collapse(self):
+        result = True
+        if self.storage is not None:
+            with profiler.phase('collapse'):
+                self.storage.carry_digests()
+                result = self.storage.flush()
+                if result:
+                    self.storage.write_digests()
+        return result
+            
+    def decode(self, node):
+        current = None
+        history = []
+        if 'current' in node:
+            current = Shift(self, node['current'])
+            
+        if 'history' in node:
+            for e in node['history']:
+                event = self.event(e)
+                if event is not None:
+                    history.append(event)
+        return current, history
+        
+    def event(self, node):
+        event = None
+        if node['type'] == 'shift':
+            event = Shift(self, node)
+            
+        elif node['type'] == 'payment':
+            event = Payment(self, node)
+        return event
+        
+    def compose(self):
+        self.node = { 'history':[], 'sorted':True, }
+        for shift in self.history:
+            self.node['history'].append(shift.node)
+            
+        if self.current is not None:
+            self.node['current'] = self.current.node
+            
+    def export(self, path):
+        self.compose()
+        try:
+            if path == '-':
+                sys.stdout.write(self.json)
+            else:
+                conf = open(path, 'w')
+                conf.write(self.json)
+                conf.close()
+        except IOError as ioerr:
+            self.log.warning(u'Failed to export %s to %s', self.name, path)
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+        else:
+            self.log.info(u'Exported %d events from project %s', len(self.history), self.name)
+            
+    def ingest(self, path, kind='json'):
+        if kind != 'json':
+            return self.absorb(path, kind)
+            
+        result = False
+        try:
+            conf = open(path, 'r')
+            stream = StringIO(conf.read())
+            conf.close()
+        except IOError as ioerr:
+            self.log.error(u'Failed to load %s', path)
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+        else:
+            try:
+                node = json.load(stream)
+            except ValueError, valerr:
+                self.log.error(u'Failed to decode JSON database %s', path)
+                self.log.debug(u'Exception raised %s', unicode(valerr))
+            else:
+                # the imported database replaces the project history
+                current, history = self.decode(node)
+                history.sort(key=lambda event: event.order)
+                self.storage.replace(current, history)
+                self.storage.forget_digests()
+                self.log.info(u'Imported %d events into project %s', len(history), self.name)
+                result = True
+        return result
+        
+    def absorb(self, path, kind):
+        # rows are appended in sorted batches of at most budget rows, rows seen before are skipped by their digest
         result = True
+        added = 0
+        skipped = 0
+        budget = ('budget' in self.env and self.env['budget']) or import_format['budget']
+        with profiler.phase('digests'):
+            digests = self.storage.digests
+            
+        batch = []
         try:
-            if not os.path.exists(path):
-                self.log.debug(u'Creating directory %s', path)
-                os.makedirs(path)
-        except OSError as err:
-            self.log.error(unicode(err))
+            for values in read_rows(path, kind):
+                if digests.add(event_digest(self.name, values)):
+                    batch.append(values)
+                else:
+                    skipped += 1
+                    
+                if len(batch) >= budget:
+                    added += self.absorb_batch(batch)
+                    batch = []
+            added += self.absorb_batch(batch)
+        except IOError as ioerr:
+            self.log.error(u'Failed to load %s', path)
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+            result = False
+        except ValueError as valerr:
+            self.log.error(u'Failed to import %s, %s', path, unicode(valerr))
             result = False
+            
+        if result:
+            self.log.info(u'Imported %d events into project %s, skipped %d already recorded', added, self.name, skipped)
+        else:
+            # rows merged before the failure are dropped with the storage
+            self.expand()
         return result
         
-    def expand(self):
-        if self.config and 'db' in self.config:
-            path = os.path.realpath(os.path.expanduser(os.path.expandvars(self.config['db'])))
-            if os.path.exists(path):
-                try:
-                    conf = open(path, 'r')
-                    stream = StringIO(conf.read())
-                    conf.close()
-                except IOError as ioerr:
-                    self.log.warning(u'Failed to load database for %s', self.name, path)
-                    self.log.debug(u'Exception raised %s', unicode(ioerr))
+    def absorb_batch(self, batch):
+        batch.sort(key=lambda values: values[1])
+        with profiler.phase('merge'):
+            self.storage.extend([ decode_event(self, *values) for values in batch ])
+        return len(batch)
+        
+    def migrate(self, location, period):
+        # the history is copied into a database at another location, the configuration is left to the user
+        config = dict(self.config)
+        config['db'] = location
+        if period is not None:
+            config['shard'] = period
+        target = ProjectBill(self.bill, config)
+        target.expand()
+        if target.storage is not None:
+            if target.current is not None or target.history:
+                self.log.error(u'Refusing to migrate %s into %s, it already holds a database', self.name, location)
+            else:
+                history = list(self.history)
+                target.storage.replace(self.current, history)
+                target.storage.forget_digests()
+                if target.collapse():
+                    self.log.info(u'Migrated %d events of project %s to %s', len(history), self.name, location)
                 else:
-                    try:
-                        self.node = json.load(stream)
-                    except ValueError, valerr:
-                        self.log.warning(u'Failed to decode JSON database for %s', self.name)
-                        self.log.debug(u'Exception raised %s', unicode(valerr))
-                    else:
-                        self._history = []
-                        if 'current' in self.node:
-                            self._current = Shift(self, self.node['current'])
-                            
-                        if 'history' in self.node:
-                            for e in self.node['history']:
-                                if e['type'] == 'shift':
-                                    self._history.append(Shift(self, e))
-                                    
-                                elif e['type'] == 'payment':
-                                    self._history.append(Payment(self, e))
-                                    
-                        # sort the history
-                        if self.env['sort']:
-                            self.volatile = True
-                            self.log.debug(u'Sorting history')
-                            self._history.sort(key=lambda event: event.order)
-                            
-            else: self.node = {}
-            
-    def collapse(self):
-        if self.volatile:
-            self.node = { 'history':[], }
-            for shift in self._history:
-                self.node['history'].append(shift.node)
+                    self.log.error(u'Failed to migrate %s to %s, it was written concurrently', self.name, location)
                 
-            if self._current is not None:
-                self.node['current'] = self._current.node
-                
-            path = os.path.realpath(os.path.expanduser(os.path.expandvars(self.config['db'])))
-            if self.varify_directory(os.path.dirname(path)):
-                self.log.debug(u'Flushing database for %s', self.name)
-                try:
-                    conf = open(path, 'w')
-                    conf.write(self.json)
-                    conf.close()
-                except IOError as ioerr:
-                    self.log.warning(u'Failed to write %s frame index %s', self.name, path)
-                    self.log.debug(u'Exception raised %s', unicode(ioerr))
-                else:
-                    self.volatile = False
-                    
     def select(self):
         query = {}
         
         # Read values from CLI
         if 'time' in self.env:
-            query['time'] = datetime.strptime(self.env['time'], expression['datetime format'])
+            query['time'] = parse_datetime(self.env['time'])
         else:
             query['time'] = datetime.now()
             
@@ -242,111 +837,74 @@ class ProjectBill(object):
         if self.current is None:
             query = self.select()
             if query is not None:
-                self.volatile = True
-                self._current = Shift(self)
-                self.current._start = query['time']
-                self.current._precision = query['quantize']
+                current = Shift(self)
+                current._start = query['time']
+                current._precision = query['quantize']
                 if 'comment' in self.env:
-                    self.current.comment = self.env['comment']
+                    current.comment = self.env['comment']
+                self.storage.update(current)
             self.log.info(u'Started a shift for project %s at %s', self.name, self.current.start)
+            return True
         else:
             self.log.error(u'Project %s already has a shift running since %s. You must close it first.', self.name, self.current.start)
+            return False
             
     def stop(self):
         if self.current is not None:
             query = self.select()
-            self.current._end = query['time']
+            current = self.current
+            current._end = query['time']
             if 'comment' in self.env:
-                self.current.comment = self.env['comment']
+                current.comment = self.env['comment']
                 
-            self.history.append(self.current)
-            current = self.current
-            self._current = None
-            self.volatile = True
+            self.storage.append(current)
+            self.storage.remember(current)
             self.log.info(u'Shift duration %s from %s to %s for project %s.', current.round_duration, current.round_start, current.round_end, self.name)
+            return True
         else:
             self.log.error(u'Project %s has no running shift. You must start one first.', self.name)
+            return False
             
     def pay(self, amount, date):
-        payment = Payment(self, {'amount':amount})
+        payment = Payment(self)
+        payment._amount = amount
         if date is None:
             payment._date = datetime.now()
         else:
             payment._date = date
             
-        self.volatile = True
-        self.history.append(payment)
+        self.storage.append(payment)
+        self.storage.remember(payment)
+        return True
         
-    def report(self, start, end):
-        total = {
-            'duration':timedelta(),
-            'shift':0,
-            'payment':0,
-            'early':None,
-            'late':None,
-            'labour':0.0,
-            'deposit':0.0,
-            'balance':0.0,
-        }
-        for event in self.history:
-            if isinstance(event, Shift):
-                if (start is None or event.round_start > start) \
-                and (end is None or event.round_start < end):
-                    if total['early'] is None or event.round_start < total['early']:
-                        total['early'] =  event.round_start
-                        
-                    if total['late'] is None or event.round_end > total['late']:
-                        total['late'] =  event.round_end
-                        
-                    # update totals
-                    total['duration'] += event.round_duration
-                    total['shift'] += 1
-                    total['labour'] += event.value
-                    total['balance'] += event.value
-                    event.balance = total['balance']
-                    
-            elif isinstance(event, Payment):
-                if (start is None or event.date > start) \
-                and (end is None or event.date < end):
-                    if total['early'] is None or event.date < total['early']:
-                        total['early'] =  event.date
-                        
-                    if total['late'] is None or event.date > total['late']:
-                        total['late'] =  event.date
-                        
-                    # update totals
-                    total['payment'] += 1
-                    total['deposit'] += event.value
-                    total['balance'] -= event.value
-                    event.balance = total['balance']
-                    
-        total['hours'] = total['duration'].total_seconds() / 3600.0
-        print u'{:<10}: {}'.format('Name', self.name)
-        print u'{:<10}: {}'.format('From', total['early'])
-        print u'{:<10}: {}'.format('To', total['late'])
-        print u'{:<10}: {}'.format('Payments', total['payment'])
-        print u'{:<10}: {}'.format('Shifts', total['shift'])
-        print u'{:<10}: {:.2f} hours'.format('Work', total['hours'])
-        print u'{:<10}: {:.2f}$'.format('Labour', total['labour'])
-        print u'{:<10}: {:.2f}$'.format('Deposit', total['deposit'])
-        print u'{:<10}: {:.2f}$'.format('Balance', total['balance'])
+    def summarize(self, start, end):
+        return summarize_events(self.storage.stream(None, end), start, end)
         
-        if self.current is not None:
-            self.current.report()
+    def aggregate(self, start, end):
+        # columns asked for with --columnar are built on open already, a backend index is only consulted without them
+        with profiler.phase('aggregate'):
+            total = None
+            if self.columns is not None:
+                total = self.columns.report(start, end)
+            if total is None:
+                total = self.storage.aggregate(start, end)
+            if total is None:
+                total = self.summarize(start, end)
+        return total
+        
+    def report(self, start, end):
+        total = self.aggregate(start, end)
+        with profiler.phase('print'):
+            print_report(self.name, total)
+            if self.current is not None:
+                self.current.report()
             
-    def monthly(self, start, end):
+    def tabulate(self, start, end):
         total = {
             'balance':0.0,
             'year':{},
         }
-        print expression['csv monthly record header'].format (
-            u'year',
-            u'month',
-            u'duration',
-            u'amount',
-            u'balance'
-        )
-        for event in self.history:
+        for event in self.storage.stream(start, end):
             if event.date:
                 if (start is None or event.date > start) and (end is None or event.date < end):
                     if event.date.year not in total['year']:
@@ -372,37 +930,66 @@ class ProjectBill(object):
                         # update totals
                         total['balance'] -= event.value
                         record['balance'] = total['balance']
+                        
+        return total
+        
+    def breakdown(self, start, end):
+        with profiler.phase('aggregate'):
+            total = self.storage.tabulate(start, end)
+            if total is None and self.columns is not None:
+                total = self.columns.monthly(start, end)
+            if total is None:
+                total = self.tabulate(start, end)
+        return total
+        
+    def monthly(self, start, end):
+        total = self.breakdown(start, end)
+        with profiler.phase('print'):
+            Renderer(self.env).render('monthly', self.months(total))
+            
+    def months(self, total):
         for year in total['year'].keys():
             for month, record in total['year'][year].iteritems():
-                print expression['csv monthly record pattern'].format(
+                yield (
                     year,
                     month,
                     round((float(record['duration'].total_seconds()) / 3600.0),2),
                     record['value'],
                     record['balance']
                 )
-                    
+                
+    def group(self, start, end, keys, metrics):
+        layout = aggregate_format
+        fields = list(keys) + list(metrics)
+        header = layout['separator'].join([ layout['header']['key'] for key in keys ] + [ layout['header'][metric] for metric in metrics ])
+        pattern = layout['separator'].join([ layout['pattern']['key'] for key in keys ] + [ layout['pattern'][metric] for metric in metrics ])
+        
+        # every key and metric comes out of a single pass over history
+        with profiler.phase('aggregate'):
+            Renderer(self.env).emit(fields, header, pattern, group_events(self.storage.stream(start, end), start, end, keys, metrics))
+            
     def balance(self, start, end):
+        renderer = Renderer(self.env)
+        
+        # rows are rendered as they are aggregated
+        with profiler.phase('balance'):
+            if self.columns is not None:
+                renderer.render('balance', self.columns.ledger(start, end, renderer))
+            else:
+                renderer.render('balance', self.ledger(start, end, renderer))
+                
+    def ledger(self, start, end, renderer):
         total = {
             'balance':0.0,
         }
-        print expression['csv record header'].format (
-            u'type',
-            u'start',
-            u'end',
-            u'duration',
-            u'amount',
-            u'balance',
-            u'comment',
-        )
-        for event in self.history:
+        for event in self.storage.stream(start, end):
             if isinstance(event, Shift):
                 if (start is None or event.round_start > start) \
                 and (end is None or event.round_start < end):
                     # update totals
                     total['balance'] += event.value
                     event.balance = total['balance']
-                    event.print_balance()
+                    yield event.row(renderer)
                     
             elif isinstance(event, Payment):
                 if (start is None or event.date > start) \
@@ -410,15 +997,25 @@ class ProjectBill(object):
                     # update totals
                     total['balance'] -= event.value
                     event.balance = total['balance']
-                    event.print_balance()
+                    yield event.row(renderer)
                     
     @property
     def current(self):
-        return self._current
+        return self.storage.current
+        
+    @property
+    def running(self):
+        if self.current is not None and self.current.running:
+            return (self.current.start, self.current.duration, self.current.comment)
+        return None
         
     @property
     def history(self):
-        return self._history
+        return self.storage.load()
+        
+    @property
+    def columns(self):
+        return self.storage.columns
         
     @property
     def name(self):
@@ -428,6 +1025,19 @@ class ProjectBill(object):
     def rate(self):
         return self.config['rate']
         
+    @property
+    def columnar(self):
+        return 'columnar' in self.env and self.env['columnar'] and load_numpy() is not None
+        
+    @property
+    def location(self):
+        # db is either a path or a URL whose scheme selects the storage backend
+        match = expression['url'].match(self.config['db'])
+        if match is not None:
+            return match.group('scheme'), match.group('path')
+        else:
+            return 'file', self.config['db']
+            
     @property
     def env(self):
          return self.bill.env
@@ -438,231 +1048,3672 @@ class ProjectBill(object):
          
 
 
-class Event(object):
-    def __init__(self, project, node={}):
-        self.log = logging.getLogger('event')
+class Storage(object):
+    def __init__(self, project):
+        self.log = logging.getLogger('storage')
         self.project = project
-        self.balance = None
-        self._node = node
+        self.current = None
+        self.volatile = False
+        self._columns = None
+        self._digests = None
+        self._added = []
+        self._replaced = False
+        self._carried = None
         
-    @property
-    def type(self):
-        return self._node['type']
+    def open(self):
+        raise NotImplementedError()
         
-    @property
-    def node(self):
-        result = {}
-        return result
+    def load(self, start=None, end=None):
+        # events in history order, a window may be widened by the largest precision
+        # since rounding moves a shift, the exact test is left to the caller
+        raise NotImplementedError()
         
-    @property
-    def date(self):
-        return None
+    def stream(self, start=None, end=None):
+        # like load, but events may be decoded only as they are consumed
+        return self.load(start, end)
         
-    @property
-    def comment(self):
-        return ('comment' in self._node and self._node['comment']) or None;
+    def append(self, event):
+        # appending the running shift closes it
+        raise NotImplementedError()
+        
+    def update(self, shift):
+        raise NotImplementedError()
+        
+    def replace(self, current, history):
+        raise NotImplementedError()
+        
+    def extend(self, events):
+        # events sorted by order, a backend may merge them in at once
+        for event in events:
+            self.append(event)
+            
+    def flush(self):
+        # False when another writer committed since the database was opened
+        raise NotImplementedError()
+        
+    def aggregate(self, start, end):
+        # report totals, or None when the backend leaves it to the caller
+        return None
+        
+    def tabulate(self, start, end):
+        # monthly totals, or None when the backend leaves it to the caller
+        return None
+        
+    def stale(self):
+        # True when another process committed since the database was opened
+        return False
+        
+    def version(self, lock):
+        result = 0
+        if lock is not None:
+            lock.seek(0)
+            text = lock.read().strip()
+            if text:
+                result = int(text)
+        return result
+        
+    def advance(self, lock, version):
+        # the lock file carries the number of commits, readers compare it to the one they opened
+        if lock is not None:
+            lock.seek(0)
+            lock.truncate()
+            lock.write(str(version))
+            lock.flush()
+            os.fsync(lock.fileno())
+        return version
+        
+    def recall_digests(self):
+        path = self.digest_path
+        if os.path.exists(path):
+            try:
+                stream = open(path, 'rb')
+                try:
+                    digests = Digests(stream)
+                finally:
+                    stream.close()
+            except (EnvironmentError, EOFError, ValueError, struct.error) as err:
+                self.log.warning(u'Failed to load import digests for %s from %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(err))
+            else:
+                # the index holds the database as it was at one version, the journal what the commits after it added
+                if digests.version != self._version:
+                    self.replay_digests(digests)
+                    
+                if digests.version == self._version:
+                    self._digests = digests
+                else:
+                    self.log.debug(u'Import digests for %s are stale', self.name)
+                    
+    def replay_digests(self, digests):
+        path = self.digest_journal_path
+        if os.path.exists(path):
+            records = {}
+            try:
+                journal = open(path, 'rb')
+                try:
+                    layout = digest_format['record']
+                    while True:
+                        header = journal.read(layout.size)
+                        if not header:
+                            break
+                        version, count = layout.unpack(header)
+                        pattern = digest_format['digest'].format(count)
+                        records[version] = struct.unpack(pattern, journal.read(struct.calcsize(pattern)))
+                finally:
+                    journal.close()
+            except (EnvironmentError, struct.error) as err:
+                self.log.warning(u'Failed to load import digest journal for %s from %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(err))
+            else:
+                # concurrent writers may append out of order, a version nobody recorded leaves the index stale
+                while digests.version < self._version and digests.version + 1 in records:
+                    for digest in records[digests.version + 1]:
+                        digests.add(digest)
+                    digests.version += 1
+                    digests.volatile = True
+                    
+
+    def remember(self, event):
+        # an event this process added, the import digests learn it in the commit that writes it
+        self._added.append(event)
+        
+    def forget_digests(self):
+        # a replaced history leaves nothing the digests on disk could be carried over to
+        self._digests = None
+        self._added = []
+        self._replaced = True
+        
+    def carry_digests(self):
+        # a commit journals what it added, the next import folds that into the index instead of rebuilding it
+        if self.volatile and not self._replaced:
+            if self._digests is not None:
+                for event in self._added:
+                    self._digests.add(event_digest(self.name, event_values(event)))
+                self._digests.volatile = True
+            else:
+                self._carried = [ event_digest(self.name, event_values(event)) for event in self._added ]
+        self._added = []
+        
+    def write_digests(self):
+        if self._digests is not None and self._digests.volatile and not self.volatile:
+            path = self.digest_path
+            self.log.debug(u'Flushing import digests for %s', self.name)
+            self._digests.version = self._version
+            try:
+                with self.atomic(path) as conf:
+                    self._digests.write(conf)
+                if os.path.exists(self.digest_journal_path):
+                    os.remove(self.digest_journal_path)
+            except EnvironmentError as ioerr:
+                self.log.warning(u'Failed to write import digests for %s to %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(ioerr))
+            else:
+                self._digests.volatile = False
+                
+        elif self._carried is not None and not self.volatile and os.path.exists(self.digest_path):
+            # every commit leaves a record, even an empty one, a missing version would make the index stale
+            path = self.digest_journal_path
+            record = digest_format['record'].pack(self._version, len(self._carried))
+            record += struct.pack(digest_format['digest'].format(len(self._carried)), *self._carried)
+            try:
+                journal = open(path, 'ab')
+                journal.write(record)
+                journal.close()
+            except EnvironmentError as ioerr:
+                self.log.warning(u'Failed to append to import digest journal for %s at %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(ioerr))
+        self._carried = None
+        
+    @contextmanager
+    def atomic(self, path):
+        # readers see the previous file or the complete new one, never a torn write
+        directory = os.path.dirname(path)
+        handle, temporary = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+        conf = os.fdopen(handle, 'wb')
+        done = False
+        try:
+            yield conf
+            conf.flush()
+            os.fsync(conf.fileno())
+            conf.close()
+            if os.path.exists(path):
+                os.chmod(temporary, os.stat(path).st_mode & 0o7777)
+            else:
+                mask = os.umask(0)
+                os.umask(mask)
+                os.chmod(temporary, 0o666 & ~mask)
+            os.rename(temporary, path)
+            done = True
+        finally:
+            if not conf.closed:
+                conf.close()
+            if not done and os.path.exists(temporary):
+                os.remove(temporary)
+                
+        # make the rename itself durable
+        descriptor = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+            
+    @contextmanager
+    def locked(self, path, operation):
+        # advisory lock on a sidecar file, the database itself is replaced on every write
+        lock = None
+        if os.path.isdir(os.path.dirname(path)):
+            try:
+                if operation == fcntl.LOCK_SH:
+                    # a reader never creates the lock file, before the first commit there is nothing to lock
+                    if os.path.exists(path):
+                        lock = open(path, 'r')
+                else:
+                    lock = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), 'r+')
+            except EnvironmentError as err:
+                self.log.debug(u'Exception raised %s', unicode(err))
+                
+        if lock is None:
+            yield None
+        else:
+            try:
+                fcntl.flock(lock.fileno(), operation)
+                yield lock
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+                lock.close()
+                
+    def varify_directory(self, path):
+        result = True
+        try:
+            if not os.path.exists(path):
+                self.log.debug(u'Creating directory %s', path)
+                os.makedirs(path)
+        except OSError as err:
+            self.log.error(unicode(err))
+            result = False
+        return result
+        
+    @property
+    def columns(self):
+        if self._columns is None and self.project.columnar:
+            self._columns = Columns(self.load())
+        return self._columns
+        
+    @property
+    def digests(self):
+        # only an import reads the index, it is rebuilt from history when another commit made it stale
+        if self._digests is None:
+            self.recall_digests()
+            
+        if self._digests is None:
+            self.log.debug(u'Rebuilding import digests for %s', self.name)
+            self._digests = Digests()
+            for event in self.stream():
+                self._digests.add(event_digest(self.name, event_values(event)))
+            self._digests.volatile = True
+        return self._digests
+        
+    @property
+    def path(self):
+        return os.path.realpath(os.path.expanduser(os.path.expandvars(self.project.location[1])))
+        
+    @property
+    def digest_path(self):
+        return self.path + '.digests'
+        
+    @property
+    def digest_journal_path(self):
+        return self.digest_path + '.journal'
+        
+    @property
+    def compact(self):
+        return 'compact' in self.project.config and self.project.config['compact']
+        
+    @property
+    def writable(self):
+        # sidecars derived while reading are only kept where this user could write the database itself
+        path = self.path
+        return os.access(os.path.dirname(path), os.W_OK) and (not os.path.exists(path) or os.access(path, os.W_OK))
+        
+    @property
+    def name(self):
+        return self.project.name
+        
+    @property
+    def env(self):
+        return self.project.env
+        
+
+
+class FileStorage(Storage):
+    def __init__(self, project):
+        Storage.__init__(self, project)
+        self.node = None
+        self._history = None
+        self._records = None
+        self._order = None
+        self._slack = timedelta()
+        self._journal = []
+        self._journal_size = 0
+        self._replayed = []
+        self._rollup = None
+        self._prefix = None
+        self._stamp = None
+        self._pending = []
+        self._snapshot = None
+        self._version = 0
+        self._hot = False
+        self.rewrite = False
+        self.deferred = False
+        
+    def stamp(self, path, conf=None):
+        if conf is not None:
+            status = os.fstat(conf.fileno())
+            return [ status.st_size, status.st_mtime ]
+        if os.path.exists(path):
+            status = os.stat(path)
+            return [ status.st_size, status.st_mtime ]
+        return None
+        
+    def open(self):
+        path = self.path
+        # readers share the lock, so a commit never lands between the snapshot and its journal
+        with self.locked(self.lock_path, fcntl.LOCK_SH) as lock:
+            self._version = self.version(lock)
+            self._stamp = self.stamp(path)
+            if self.hot and os.path.exists(self.state_path):
+                # the running shift is kept apart, the history is only decoded once something reads it
+                if self.binary and os.path.exists(path):
+                    self.read_binary(path)
+                elif os.path.exists(path):
+                    self.node = { 'sorted':True }
+                    self.deferred = True
+                    self.hold(path)
+                else:
+                    self.node = {}
+                    self._history = []
+                    self.index()
+                self.read_state(self.state_path)
+                
+            elif os.path.exists(path):
+                if self.binary:
+                    self.read_binary(path)
+                elif self.streaming and self.presorted(path):
+                    self.read_head(path)
+                else:
+                    self.read_json(path)
+            else:
+                self.node = {}
+                self._history = []
+                self.index()
+                
+            if self.node is not None:
+                # history is kept sorted, a database written before that is sorted once
+                if self.env['sort'] or not ('sorted' in self.node and self.node['sorted']):
+                    if self.history:
+                        self.volatile = True
+                        self.rewrite = True
+                        with profiler.phase('sort'):
+                            self.log.debug(u'Sorting history')
+                            self._history.sort(key=lambda event: event.order)
+                            self.index()
+                        
+                if self.journaled:
+                    with profiler.phase('replay'):
+                        self.replay()
+                        
+                self.recall()
+                if self.project.columnar and not self.deferred:
+                    with profiler.phase('columns'):
+                        self._columns = self.columnize()
+                        
+                # a database that kept its running shift inline moves it out on the next write
+                if self.hot and not os.path.exists(self.state_path) and os.path.exists(path):
+                    self._hot = True
+                    self.volatile = True
+                    self.rewrite = True
+                    
+    def hold(self, path):
+        # a deferred history is read later from the snapshot open now, under the shared lock,
+        # a commit that replaces the file in between does not replay the journal over its own snapshot
+        self._snapshot = open(path, 'r')
+        
+    def read_json(self, path, conf=None):
+        # an unchanged snapshot is taken from its decoded cache, without parsing JSON or dates
+        if self.cached and self.read_cache(path, conf):
+            return
+            
+        try:
+            with profiler.phase('read'):
+                if conf is None:
+                    conf = open(path, 'r')
+                conf.seek(0)
+                status = os.fstat(conf.fileno())
+                text = conf.read()
+                conf.close()
+                stream = StringIO(text)
+        except IOError as ioerr:
+            self.log.warning(u'Failed to load database for %s from %s', self.name, path)
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+        else:
+            try:
+                with profiler.phase('parse'):
+                    node = json.load(stream)
+            except ValueError, valerr:
+                self.log.warning(u'Failed to decode JSON database for %s', self.name)
+                self.log.debug(u'Exception raised %s', unicode(valerr))
+            else:
+                self.node = node
+                with profiler.phase('construct'):
+                    self.current, self._history = self.project.decode(node)
+                    self.index()
+                    
+                if self.cached and self.writable:
+                    self.write_cache([ status.st_size, status.st_mtime ], node, (self.cache_hash and hashlib.sha1(text).hexdigest()) or None)
+                    
+    def read_cache(self, path, snapshot=None):
+        result = False
+        cache = self.cache_path
+        if os.path.exists(cache):
+            try:
+                with profiler.phase('cache'):
+                    conf = open(cache, 'rb')
+                    payload = marshal.loads(conf.read())
+                    conf.close()
+                    
+                    valid = payload['magic'] == cache_format['magic'] and \
+                    payload['version'] == cache_format['version'] and \
+                    payload['marshal'] == marshal.version and \
+                    payload['snapshot'] == self.stamp(path, snapshot)
+                    if valid and self.cache_hash:
+                        valid = payload['hash'] == self.digest(path, snapshot)
+                        
+                    if valid:
+                        current = None
+                        if payload['current'] is not None:
+                            current = Shift(self.project, payload['current'])
+                        history = [ decode_event(self.project, *values) for values in zip(*payload['history']) ]
+            except (EnvironmentError, EOFError, ValueError, TypeError, KeyError, IndexError) as err:
+                self.log.warning(u'Failed to load decoded cache for %s from %s', self.name, cache)
+                self.log.debug(u'Exception raised %s', unicode(err))
+            else:
+                if valid:
+                    self.node = { 'sorted':payload['sorted'] }
+                    self.current = current
+                    self._history = history
+                    self.index()
+                    result = True
+                else:
+                    self.log.debug(u'Decoded cache for %s is stale', self.name)
+        return result
+        
+    def read_state(self, path):
+        try:
+            conf = open(path, 'r')
+            node = json.load(conf)
+            conf.close()
+        except (IOError, ValueError) as err:
+            self.log.warning(u'Failed to load running shift for %s from %s', self.name, path)
+            self.log.debug(u'Exception raised %s', unicode(err))
+        else:
+            self.current = None
+            if 'current' in node:
+                self.current = Shift(self.project, node['current'])
+                
+    def presorted(self, path):
+        # the sorted flag is written after the history, so it is looked for at the end of the file
+        result = False
+        try:
+            conf = open(path, 'r')
+            conf.seek(max(0, self._stamp[0] - 256))
+            result = expression['json sorted tail'].search(conf.read()) is not None
+            conf.close()
+        except IOError as ioerr:
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+        return result
+        
+    def read_head(self, path):
+        # only what precedes the history is decoded now, the history is streamed when consumed
+        try:
+            self.hold(path)
+            for key, node in JsonStream(path, file=self._snapshot):
+                if key == 'history':
+                    break
+                    
+                elif key == 'current':
+                    self.current = Shift(self.project, node)
+        except (IOError, ValueError), err:
+            self.log.warning(u'Failed to decode JSON database for %s', self.name)
+            self.log.debug(u'Exception raised %s', unicode(err))
+            if self._snapshot is not None:
+                self._snapshot.close()
+                self._snapshot = None
+        else:
+            self.node = { 'sorted':True }
+            self.deferred = True
+            
+    def restore(self):
+        # something needs the whole history after all, the running shift may come from the journal
+        self.log.debug(u'Decoding deferred history for %s', self.name)
+        current = self.current
+        self.deferred = False
+        self.read_json(self.path, self._snapshot)
+        if self._snapshot is not None and not self._snapshot.closed:
+            self._snapshot.close()
+        self._snapshot = None
+        self.current = current
+        if self._history is None:
+            self._history = []
+            self.index()
+            
+        for event in self._pending:
+            self.insert(event)
+        self._pending = []
+        
+    def read_binary(self, path):
+        try:
+            with profiler.phase('read'):
+                self._records = Records(path)
+        except (EnvironmentError, ValueError, struct.error), err:
+            self.log.warning(u'Failed to load binary database for %s from %s', self.name, path)
+            self.log.debug(u'Exception raised %s', unicode(err))
+        else:
+            # history is decoded from the records on first access
+            self.node = { 'sorted':self._records.sorted }
+            if self._records.current is not None:
+                self.current = self._records.event(self.project, self._records.current)
+                
+    def replay(self):
+        path = self.journal_path
+        if os.path.exists(path):
+            try:
+                journal = open(path, 'r')
+                lines = journal.readlines()
+                journal.close()
+            except IOError as ioerr:
+                self.log.warning(u'Failed to load journal for %s from %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(ioerr))
+            else:
+                for line in lines:
+                    try:
+                        record = json.loads(line)
+                    except ValueError, valerr:
+                        # a torn write can only ever affect the last line
+                        self.log.warning(u'Ignoring corrupt journal record for %s', self.name)
+                        self.log.debug(u'Exception raised %s', unicode(valerr))
+                    else:
+                        self._replayed.append(self.apply(record))
+                        self._journal_size += 1
+                self.log.debug(u'Replayed %d journal records for %s', self._journal_size, self.name)
+                
+    def apply(self, record):
+        event = None
+        if record['op'] == 'start':
+            self.current = Shift(self.project, record['event'])
+            
+        elif record['op'] == 'clear':
+            self.current = None
+            
+        elif record['op'] == 'stop':
+            self.current = None
+            event = Shift(self.project, record['event'])
+            
+        elif record['op'] == 'append':
+            if record['event']['type'] == 'shift':
+                event = Shift(self.project, record['event'])
+                
+            elif record['event']['type'] == 'payment':
+                event = Payment(self.project, record['event'])
+                
+        if event is not None:
+            self.insert(event)
+        return event
+        
+    def recall(self):
+        path = self.rollup_path
+        if os.path.exists(path):
+            try:
+                conf = open(path, 'r')
+                stream = StringIO(conf.read())
+                conf.close()
+            except IOError as ioerr:
+                self.log.warning(u'Failed to load monthly rollups for %s from %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(ioerr))
+            else:
+                try:
+                    rollup = Rollup(json.load(stream))
+                except (ValueError, KeyError), valerr:
+                    self.log.warning(u'Failed to decode monthly rollups for %s', self.name)
+                    self.log.debug(u'Exception raised %s', unicode(valerr))
+                else:
+                    # rollups are valid for a snapshot and a prefix of its journal, as long as the rest comes in order
+                    if rollup.snapshot != self._stamp or rollup.journal > len(self._replayed):
+                        rollup = None
+                    else:
+                        for event in self._replayed[rollup.journal:]:
+                            if event is not None:
+                                if not rollup.follows(event):
+                                    rollup = None
+                                    break
+                                rollup.add(event)
+                                
+                    if rollup is not None:
+                        rollup.journal = len(self._replayed)
+                        self._rollup = rollup
+                    else:
+                        self.log.debug(u'Monthly rollups for %s are stale', self.name)
+                        
+    def recall_prefix(self):
+        path = self.prefix_path
+        if os.path.exists(path):
+            try:
+                stream = open(path, 'rb')
+                try:
+                    prefix = Prefix(stream)
+                finally:
+                    stream.close()
+            except (EnvironmentError, EOFError, ValueError, struct.error) as err:
+                self.log.warning(u'Failed to load prefix index for %s from %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(err))
+            else:
+                # like the rollups, the index is valid for a snapshot and a prefix of its journal
+                if prefix.snapshot == self._stamp and prefix.journal <= len(self._replayed):
+                    # a backdated journal event moved the running sums, they are written back once settled
+                    if prefix.extend(self._replayed[prefix.journal:]) is not None:
+                        prefix.volatile = True
+                    prefix.journal = len(self._replayed)
+                    self._prefix = prefix
+                else:
+                    self.log.debug(u'Prefix index for %s is stale', self.name)
+                    
+    def index(self):
+        self._order = [ event.order for event in self._history ]
+        self._slack = timedelta()
+        for event in self._history:
+            if isinstance(event, Shift) and abs(event.precision) > self._slack:
+                self._slack = abs(event.precision)
+                
+    def insert(self, event):
+        if self.deferred:
+            self._pending.append(event)
+            return
+            
+        history = self.history
+        position = bisect.bisect_right(self._order, event.order)
+        self._order.insert(position, event.order)
+        history.insert(position, event)
+        if isinstance(event, Shift) and abs(event.precision) > self._slack:
+            self._slack = abs(event.precision)
+            
+    def load(self, start=None, end=None):
+        history = self.history
+        lower = 0
+        upper = len(history)
+        if start is None and end is None:
+            return history
+            
+        if start is not None:
+            lower = bisect.bisect_left(self._order, start - self._slack)
+        if end is not None:
+            upper = bisect.bisect_right(self._order, end + self._slack)
+        return history[lower:upper]
+        
+    def stream(self, start=None, end=None):
+        if self.deferred:
+            return self.iterate()
+            
+        elif self._history is None and self._records is not None:
+            # mapped records are decoded one at a time rather than into a history
+            return ( self._records.event(self.project, values) for values in self._records )
+        return self.load(start, end)
+        
+    def iterate(self):
+        # snapshot events are decoded as they are read, journal events are merged in by order
+        pending = sorted(self._pending, key=lambda event: event.order)
+        position = 0
+        try:
+            for key, node in JsonStream(self.path, file=self._snapshot):
+                if key == 'history':
+                    event = self.project.event(node)
+                    if event is not None:
+                        while position < len(pending) and pending[position].order < event.order:
+                            yield pending[position]
+                            position += 1
+                        yield event
+        except (IOError, ValueError), err:
+            self.log.warning(u'Failed to stream database for %s from %s', self.name, self.path)
+            self.log.debug(u'Exception raised %s', unicode(err))
+            
+        for event in pending[position:]:
+            yield event
+            
+    def append(self, event):
+        self.insert(event)
+        if event is self.current:
+            self.current = None
+            if self.hot:
+                # the cold store only ever sees closed events
+                self._hot = True
+                self.record('append', event)
+            else:
+                self.record('stop', event)
+        else:
+            self.record('append', event)
+            
+    def update(self, shift):
+        self.current = shift
+        if self.hot:
+            self._hot = True
+            self.volatile = True
+        elif shift is not None:
+            self.record('start', shift)
+        else:
+            self.record('clear', None)
+            
+    def replace(self, current, history):
+        self.current = current
+        self._history = history
+        self.index()
+        self._columns = None
+        self._rollup = None
+        self._prefix = None
+        self._hot = self.hot
+        self.volatile = True
+        self.rewrite = True
+        
+    def extend(self, events):
+        # only the part of history from the first new event on is merged, the snapshot is then written once
+        if events:
+            history = self.history
+            position = bisect.bisect_right(self._order, events[0].order)
+            merged = merge_events(history[position:], events)
+            history[position:] = merged
+            self._order[position:] = [ event.order for event in merged ]
+            for event in events:
+                if isinstance(event, Shift) and abs(event.precision) > self._slack:
+                    self._slack = abs(event.precision)
+            self._columns = None
+            self._rollup = None
+            self._prefix = None
+            self.volatile = True
+            self.rewrite = True
+            
+    def record(self, op, event):
+        self.volatile = True
+        self._columns = None
+        self._journal.append({ 'op':op, 'event':(event is not None and event.node) or None })
+        if op in ('stop', 'append'):
+            # a backdated event drops the rollups, they are rebuilt from history when next needed
+            if self._rollup is not None and not self._rollup.follows(event):
+                self._rollup = None
+            for sidecar in (self._rollup, self._prefix):
+                if sidecar is not None:
+                    sidecar.add(event)
+        else:
+            event = None
+        # the journal as this process knows it, for an index that is only loaded later
+        self._replayed.append(event)
+        
+    def aggregate(self, start, end):
+        prefix = self.prefix
+        if prefix is not None:
+            return prefix.total(start, end)
+        return None
+        
+    def tabulate(self, start, end):
+        if start is None and end is None:
+            # a deferred history is not decoded only to build the rollups
+            rollup = self._rollup
+            if rollup is None and not self.deferred:
+                rollup = self.rollup
+                
+            if rollup is not None:
+                return rollup.total
+        return None
+        
+    def flush(self):
+        if self.volatile and self.varify_directory(os.path.dirname(self.path)):
+            # the lock is only held to commit, a writer that read an older version has to start over
+            with self.locked(self.lock_path, fcntl.LOCK_EX) as lock:
+                version = self.version(lock)
+                if version != self._version:
+                    self.log.debug(u'Database for %s moved from version %d to %d', self.name, self._version, version)
+                    return False
+                    
+                if self.journaled and not self.rewrite and \
+                self._journal_size + len(self._journal) < self.journal_limit:
+                    if self._journal:
+                        self.append_journal()
+                    else:
+                        self.volatile = False
+                else:
+                    # an index left on disk is brought along, so the next report does not rebuild it from every event
+                    if self._prefix is None and not self.rewrite:
+                        self.recall_prefix()
+                    self.write_snapshot()
+                    
+                # the closed shift is in the journal before the state file stops calling it running
+                if self._hot and not self.volatile:
+                    self.write_state(self.state_path)
+                    
+                if not self.volatile and lock is not None:
+                    self._version = self.advance(lock, version + 1)
+                    
+        if not self.volatile and self.writable:
+            if self._rollup is not None and self._rollup.volatile:
+                self.write_rollup()
+            if self._prefix is not None and self._prefix.volatile:
+                self.write_prefix()
+        return True
+        
+    def stale(self):
+        with self.locked(self.lock_path, fcntl.LOCK_SH) as lock:
+            return self.version(lock) != self._version
+            
+    def write_state(self, path):
+        node = {}
+        if self.current is not None:
+            node['current'] = self.current.node
+        try:
+            with self.atomic(path) as conf:
+                conf.write(json.dumps(node, ensure_ascii=False, sort_keys=True, indent=4, default=default_json_handler).encode('utf-8'))
+        except EnvironmentError as ioerr:
+            self.log.warning(u'Failed to write running shift for %s to %s', self.name, path)
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+        else:
+            self._hot = False
+            
+    def write_cache(self, stamp, node, digest):
+        # the snapshot as it is on disk, its running shift is kept as the raw node
+        columns = [ [] for column in cache_format['columns'] ]
+        for event in self._history:
+            for column, value in zip(columns, event_values(event)):
+                column.append(value)
+                
+        payload = {
+            'magic':cache_format['magic'],
+            'version':cache_format['version'],
+            'marshal':marshal.version,
+            'snapshot':stamp,
+            'hash':digest,
+            'sorted':bool('sorted' in node and node['sorted']),
+            'current':('current' in node and node['current']) or None,
+            'history':columns,
+        }
+        try:
+            with self.atomic(self.cache_path) as conf:
+                conf.write(marshal.dumps(payload))
+        except (EnvironmentError, ValueError) as err:
+            self.log.warning(u'Failed to write decoded cache for %s to %s', self.name, self.cache_path)
+            self.log.debug(u'Exception raised %s', unicode(err))
+            
+    def digest(self, path, snapshot=None):
+        if snapshot is not None:
+            snapshot.seek(0)
+            return hashlib.sha1(snapshot.read()).hexdigest()
+            
+        conf = open(path, 'rb')
+        try:
+            return hashlib.sha1(conf.read()).hexdigest()
+        finally:
+            conf.close()
+            
+    def write_rollup(self):
+        path = self.rollup_path
+        self.log.debug(u'Flushing monthly rollups for %s', self.name)
+        try:
+            with self.atomic(path) as conf:
+                conf.write(json.dumps(self._rollup.node, sort_keys=True))
+        except EnvironmentError as ioerr:
+            self.log.warning(u'Failed to write monthly rollups for %s to %s', self.name, path)
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+        else:
+            self._rollup.volatile = False
+            
+    def write_prefix(self):
+        path = self.prefix_path
+        self.log.debug(u'Flushing prefix index for %s', self.name)
+        try:
+            with self.atomic(path) as conf:
+                self._prefix.write(conf)
+        except EnvironmentError as ioerr:
+            self.log.warning(u'Failed to write prefix index for %s to %s', self.name, path)
+            self.log.debug(u'Exception raised %s', unicode(ioerr))
+        else:
+            self._prefix.volatile = False
+            
+    def append_journal(self):
+        path = self.journal_path
+        if self.varify_directory(os.path.dirname(path)):
+            self.log.debug(u'Appending %d records to journal for %s', len(self._journal), self.name)
+            try:
+                journal = open(path, 'a')
+                for record in self._journal:
+                    journal.write(json.dumps(record, ensure_ascii=False, sort_keys=True, default=default_json_handler).encode('utf-8'))
+                    journal.write('\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+                journal.close()
+            except EnvironmentError as ioerr:
+                self.log.warning(u'Failed to append to journal for %s at %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(ioerr))
+            else:
+                self._journal_size += len(self._journal)
+                self._journal = []
+                self.volatile = False
+                if self._rollup is not None:
+                    self._rollup.journal = self._journal_size
+                    self._rollup.volatile = True
+                    
+                # the index on disk is still valid for the journal records it counts, it is not rewritten for an append
+                if self._prefix is not None and self._prefix.volatile:
+                    self._prefix.journal = self._journal_size
+                    
+    def write_snapshot(self):
+        path = self.path
+        if self.varify_directory(os.path.dirname(path)):
+            self.log.debug(u'Flushing database for %s', self.name)
+            writer = None
+            try:
+                if self.binary:
+                    self.write_binary(path)
+                else:
+                    # events are encoded one at a time straight into the file, the whole text is never held
+                    node = { 'sorted':True }
+                    if self.current is not None and not self.hot:
+                        node['current'] = self.current.node
+                    with self.atomic(path) as conf:
+                        writer = JsonWriter(conf, self.compact, self.cached and self.cache_hash)
+                        writer.write(node, ( event.node for event in self.history ))
+            except EnvironmentError as ioerr:
+                self.log.warning(u'Failed to write %s frame index %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(ioerr))
+            else:
+                # the snapshot now contains everything the journal did
+                if self.journaled and os.path.exists(self.journal_path):
+                    self.log.debug(u'Compacting journal for %s', self.name)
+                    try:
+                        os.remove(self.journal_path)
+                    except OSError as oserr:
+                        self.log.warning(u'Failed to remove journal for %s at %s', self.name, self.journal_path)
+                        self.log.debug(u'Exception raised %s', unicode(oserr))
+                self._journal = []
+                self._journal_size = 0
+                self._replayed = []
+                self.volatile = False
+                self.rewrite = False
+                self._stamp = self.stamp(path)
+                for sidecar in (self._rollup, self._prefix):
+                    if sidecar is not None:
+                        sidecar.snapshot = self._stamp
+                        sidecar.journal = 0
+                        sidecar.volatile = True
+                        
+                # the next process to read the snapshot finds it decoded already
+                if self.cached and writer is not None:
+                    self.write_cache(self._stamp, node, writer.digest)
+                    
+    def write_binary(self, path):
+        history = self.history
+        if self._records is not None:
+            # the map would otherwise pin the replaced file
+            self._records.close()
+            self._records = None
+            
+        strings = []
+        offset = [0]
+        def encode(event):
+            values = [
+                binary_format['null']['time'],
+                binary_format['null']['time'],
+                binary_format['null']['precision'],
+                float('nan'),
+                0.0,
+                binary_format['type']['none'],
+                0,
+                binary_format['null']['string'],
+            ]
+            if isinstance(event, Shift):
+                values[5] = binary_format['type']['shift']
+                if event.start is not None:
+                    values[0] = datetime_to_microseconds(event.start)
+                if event.end is not None:
+                    values[1] = datetime_to_microseconds(event.end)
+                if event.precision is not None:
+                    values[2] = int(event.precision.total_seconds())
+                if event.rate is not None:
+                    values[3] = float(event.rate)
+                    
+            elif isinstance(event, Payment):
+                values[5] = binary_format['type']['payment']
+                values[0] = datetime_to_microseconds(event.date)
+                values[1] = values[0]
+                values[4] = float(event.value)
+                
+            if event is not None and event.comment is not None:
+                comment = event.comment
+                if isinstance(comment, unicode):
+                    comment = comment.encode('utf-8')
+                values[6] = offset[0]
+                values[7] = len(comment)
+                strings.append(comment)
+                offset[0] += len(comment)
+            return binary_format['record'].pack(*values)
+            
+        current = (not self.hot and self.current) or None
+        flags = binary_format['flag']['sorted']
+        if current is not None:
+            flags |= binary_format['flag']['current']
+        table = binary_format['header'].size + binary_format['record'].size * (len(history) + 1)
+        
+        # records come before the strings in the file, but the string table is only complete once every record is encoded
+        records = [ encode(current) ]
+        for event in history:
+            records.append(encode(event))
+            
+        with self.atomic(path) as conf:
+            conf.write(binary_format['header'].pack(binary_format['magic'], binary_format['version'], flags, len(history), table))
+            for record in records:
+                conf.write(record)
+            for string in strings:
+                conf.write(string)
+        
+    @property
+    def history(self):
+        if self._history is None and self._records is not None:
+            with profiler.phase('construct'):
+                self._history = [ self._records.event(self.project, values) for values in self._records ]
+                self.index()
+            
+        elif self._history is None and self.deferred:
+            self.restore()
+        return self._history
+        
+    @property
+    def columns(self):
+        if self._columns is None and self.project.columnar and self.node is not None and not self.deferred:
+            self._columns = self.columnize()
+        return self._columns
+        
+    def columnize(self):
+        if self._history is None and self._records is not None:
+            return Columns(records=self._records)
+        else:
+            return Columns(self.history)
+            
+    @property
+    def rollup(self):
+        if self._rollup is None and self.node is not None:
+            self.log.debug(u'Rebuilding monthly rollups for %s', self.name)
+            self._rollup = Rollup()
+            for event in self.history:
+                self._rollup.add(event)
+            self._rollup.snapshot = self._stamp
+            self._rollup.journal = self._journal_size
+            self._rollup.volatile = True
+        return self._rollup
+        
+    @property
+    def prefix(self):
+        # the index is only read when something aggregates, a plain stop or pay never loads it
+        if self._prefix is None and self.node is not None and not self.rewrite:
+            self.recall_prefix()
+            
+        if self._prefix is None and self.node is not None:
+            self.log.debug(u'Rebuilding prefix index for %s', self.name)
+            # a deferred history is streamed into the index rather than decoded
+            self._prefix = Prefix()
+            self._prefix.extend(self.stream())
+            self._prefix.snapshot = self._stamp
+            self._prefix.journal = self._journal_size
+            self._prefix.volatile = True
+        return self._prefix
+        
+    @property
+    def rollup_path(self):
+        return self.path + '.monthly'
+        
+    @property
+    def cache_path(self):
+        return self.path + '.cache'
+        
+    @property
+    def prefix_path(self):
+        return self.path + '.prefix'
+        
+    @property
+    def binary(self):
+        return self.project.location[0] == 'binary' or \
+        ('format' in self.project.config and self.project.config['format'] == 'binary')
+        
+    @property
+    def streaming(self):
+        return 'stream' in self.env and self.env['stream'] and not self.env['sort']
+        
+    @property
+    def cached(self):
+        return 'cache' in self.project.config and self.project.config['cache']
+        
+    @property
+    def cache_hash(self):
+        # size and mtime miss a rewrite of the same size within the clock resolution, the hash does not
+        return 'cache hash' in self.project.config and self.project.config['cache hash']
+        
+    @property
+    def journaled(self):
+        # a split project appends closed events, so the journal is its cold store
+        return self.hot or ('journal' in self.project.config and self.project.config['journal'])
+        
+    @property
+    def hot(self):
+        return 'hot state' in self.project.config and self.project.config['hot state']
+        
+    @property
+    def state_path(self):
+        return self.path + '.current'
+        
+    @property
+    def journal_path(self):
+        return self.path + '.journal'
+        
+    @property
+    def lock_path(self):
+        return self.path + '.lock'
+        
+    @property
+    def journal_limit(self):
+        return ('journal limit' in self.project.config and self.project.config['journal limit']) or 1024
+        
+
+
+class ShardStorage(Storage):
+    def __init__(self, project):
+        Storage.__init__(self, project)
+        self.manifest = None
+        self._shards = {}
+        self._order = {}
+        self._dirty = set()
+        self._dropped = set()
+        self._version = 0
+        self._healed = False
+        
+    def open(self):
+        # only the manifest is read now, shards are read when a query reaches them
+        with self.locked(self.lock_path, fcntl.LOCK_SH) as lock:
+            self._version = self.version(lock)
+            self.read_manifest()
+            
+    def read_manifest(self):
+        path = self.manifest_path
+        self.manifest = None
+        self.current = None
+        self._shards = {}
+        self._order = {}
+        if os.path.exists(path):
+            try:
+                conf = open(path, 'r')
+                stream = StringIO(conf.read())
+                conf.close()
+            except IOError as ioerr:
+                self.log.warning(u'Failed to load shard manifest for %s from %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(ioerr))
+            else:
+                try:
+                    node = json.load(stream)
+                except ValueError, valerr:
+                    self.log.warning(u'Failed to decode shard manifest for %s', self.name)
+                    self.log.debug(u'Exception raised %s', unicode(valerr))
+                else:
+                    self.manifest = node
+                    if 'current' in node:
+                        self.current = Shift(self.project, node['current'])
+        else:
+            self.manifest = {
+                'period':('shard' in self.project.config and self.project.config['shard']) or 'month',
+                'shards':[],
+            }
+            
+    def read_shard(self, name):
+        if name not in self._shards:
+            events = []
+            path = self.shard_path(name)
+            if os.path.exists(path):
+                try:
+                    conf = open(path, 'r')
+                    stream = StringIO(conf.read())
+                    conf.close()
+                    node = json.load(stream)
+                except (IOError, ValueError) as err:
+                    self.log.warning(u'Failed to load shard %s of %s from %s', name, self.name, path)
+                    self.log.debug(u'Exception raised %s', unicode(err))
+                else:
+                    current, events = self.project.decode(node)
+            self.log.debug(u'Read %d events from shard %s of %s', len(events), name, self.name)
+            self._shards[name] = events
+            self._order[name] = [ event.order for event in events ]
+        return self._shards[name]
+        
+    def scope(self, start, end):
+        # shards are read under the shared lock, a manifest superseded since it was read is read again first
+        with self.locked(self.lock_path, fcntl.LOCK_SH) as lock:
+            version = self.version(lock)
+            if version != self._version and not self.volatile:
+                self.log.debug(u'Shards of %s moved from version %d to %d', self.name, self._version, version)
+                self._version = version
+                self._healed = False
+                self.read_manifest()
+                
+            names = self.overlap(start, end)
+            for name in names:
+                self.read_shard(name)
+        return names
+        
+    def fetch(self, names):
+        with self.locked(self.lock_path, fcntl.LOCK_SH) as lock:
+            for name in names:
+                self.read_shard(name)
+        
+    def overlap(self, start, end):
+        # a shard is bounded by the order of its events, rounding moves a shift by less than the slack
+        names = []
+        slack = self.slack
+        for entry in self.entries:
+            if (start is None or entry['last'] >= datetime_to_microseconds(start) - slack) \
+            and (end is None or entry['first'] <= datetime_to_microseconds(end) + slack):
+                names.append(entry['name'])
+        return names
+        
+    def load(self, start=None, end=None):
+        history = []
+        slack = timedelta(microseconds=self.slack)
+        for name in self.scope(start, end):
+            events = self._shards[name]
+            lower = 0
+            upper = len(events)
+            if start is not None:
+                lower = bisect.bisect_left(self._order[name], start - slack)
+            if end is not None:
+                upper = bisect.bisect_right(self._order[name], end + slack)
+            history.extend(events[lower:upper])
+        return history
+        
+    def aggregate(self, start, end):
+        # shards wholly before the window only carry the balance they closed with into it
+        events = []
+        for name in self.scope(start, end):
+            events.extend(self._shards[name])
+            
+        opening = 0.0
+        if start is not None:
+            before = [ position for position, entry in enumerate(self.entries) if entry['last'] < datetime_to_microseconds(start) - self.slack ]
+            if before:
+                opening = self.closing(before[-1])
+        return summarize_events(events, start, end, opening)
+        
+    def closing(self, position):
+        # a backdated write leaves the closing balances after it out, they are summed again once a report needs one
+        entries = self.entries
+        valid = position
+        while valid >= 0 and entries[valid]['closing'] is None:
+            valid -= 1
+            
+        if valid < position:
+            self.fetch([ entry['name'] for entry in entries[valid + 1:position + 1] ])
+            self.close(valid + 1, position + 1)
+            self._healed = True
+        return entries[position]['closing']
+        
+    def append(self, event):
+        name = self.shard_of(event)
+        self.fetch([ name ])
+        events = self._shards[name]
+        position = bisect.bisect_right(self._order[name], event.order)
+        self._order[name].insert(position, event.order)
+        events.insert(position, event)
+        if event is self.current:
+            self.current = None
+            
+        # only the shard written to is read, closing balances of the shards after it are left out
+        position = self.tally(name)
+        entries = self.entries
+        if position == 0 or entries[position - 1]['closing'] is not None:
+            self.close(position, position + 1)
+        else:
+            entries[position]['closing'] = None
+        for entry in entries[position + 1:]:
+            entry['closing'] = None
+            
+        self._dirty.add(name)
+        self.volatile = True
+        
+    def update(self, shift):
+        self.current = shift
+        self.volatile = True
+        
+    def replace(self, current, history):
+        self.current = current
+        self._dropped.update(entry['name'] for entry in self.manifest['shards'])
+        self.manifest['shards'] = []
+        self._shards = {}
+        self._order = {}
+        for event in history:
+            name = self.shard_of(event)
+            if name not in self._shards:
+                self._shards[name] = []
+            self._shards[name].append(event)
+            
+        for name in sorted(self._shards.keys()):
+            self._order[name] = [ event.order for event in self._shards[name] ]
+            self.tally(name)
+            self._dirty.add(name)
+        self.close(0, len(self.entries))
+        self.volatile = True
+        
+    def extend(self, events):
+        # each shard written to is merged and tallied once, like append the closings after the first are left out
+        groups = {}
+        for event in events:
+            name = self.shard_of(event)
+            if name not in groups:
+                groups[name] = []
+            groups[name].append(event)
+            
+        if groups:
+            self.fetch(sorted(groups.keys()))
+            for name in sorted(groups.keys()):
+                self._shards[name] = merge_events(self._shards[name], groups[name])
+                self._order[name] = [ event.order for event in self._shards[name] ]
+                self.tally(name)
+                self._dirty.add(name)
+                
+            entries = self.entries
+            names = [ entry['name'] for entry in entries ]
+            position = names.index(min(groups.keys()))
+            if position == 0 or entries[position - 1]['closing'] is not None:
+                self.close(position, position + 1)
+            else:
+                entries[position]['closing'] = None
+            for entry in entries[position + 1:]:
+                entry['closing'] = None
+            self.volatile = True
+        
+    def tally(self, name):
+        names = [ entry['name'] for entry in self.manifest['shards'] ]
+        position = bisect.bisect_left(names, name)
+        if position == len(names) or names[position] != name:
+            self.manifest['shards'].insert(position, { 'name':name })
+            
+        entry = self.manifest['shards'][position]
+        events = self._shards[name]
+        entry.update({
+            'first':datetime_to_microseconds(events[0].order),
+            'last':datetime_to_microseconds(events[-1].order),
+            'shift':0,
+            'payment':0,
+            'duration':0,
+            'labour':0.0,
+            'deposit':0.0,
+            'slack':0,
+        })
+        for event in events:
+            if isinstance(event, Shift):
+                entry['shift'] += 1
+                entry['duration'] += delta_to_microseconds(event.round_duration)
+                entry['labour'] += event.value
+                entry['slack'] = max(entry['slack'], delta_to_microseconds(abs(event.precision)))
+                
+            elif isinstance(event, Payment):
+                entry['payment'] += 1
+                entry['deposit'] += event.value
+        return position
+        
+    def close(self, lower, upper):
+        # the closing balance is summed from the first event on, so it rounds like the event loop
+        entries = self.entries
+        closing = 0.0
+        if lower > 0:
+            closing = entries[lower - 1]['closing']
+        for entry in entries[lower:upper]:
+            for event in self._shards[entry['name']]:
+                if isinstance(event, Shift):
+                    closing += event.value
+                elif isinstance(event, Payment):
+                    closing -= event.value
+            entry['closing'] = closing
+            
+    def flush(self):
+        if not self.volatile and self._healed and self.writable:
+            self.heal()
+            
+        if self.volatile and self.manifest is not None and self.varify_directory(self.path):
+            with self.locked(self.lock_path, fcntl.LOCK_EX) as lock:
+                version = self.version(lock)
+                if version != self._version:
+                    self.log.debug(u'Shards of %s moved from version %d to %d', self.name, self._version, version)
+                    return False
+                    
+                # shards go first, the manifest that points at them last
+                try:
+                    for name in sorted(self._dirty):
+                        self.write_shard(name)
+                    for name in self._dropped.difference(self._shards.keys()):
+                        if os.path.exists(self.shard_path(name)):
+                            os.remove(self.shard_path(name))
+                    self.write_manifest()
+                except EnvironmentError as ioerr:
+                    self.log.warning(u'Failed to write shards of %s to %s', self.name, self.path)
+                    self.log.debug(u'Exception raised %s', unicode(ioerr))
+                else:
+                    self.log.debug(u'Flushed %d shards of %s', len(self._dirty), self.name)
+                    self._dirty = set()
+                    self._dropped = set()
+                    self._healed = False
+                    self.volatile = False
+                    if lock is not None:
+                        self._version = self.advance(lock, version + 1)
+        return True
+        
+    def heal(self):
+        # closing balances summed again for a report only change what is derived, the version stays
+        with self.locked(self.lock_path, fcntl.LOCK_EX) as lock:
+            if self.version(lock) == self._version:
+                try:
+                    self.write_manifest()
+                except EnvironmentError as ioerr:
+                    self.log.warning(u'Failed to write shard manifest of %s to %s', self.name, self.manifest_path)
+                    self.log.debug(u'Exception raised %s', unicode(ioerr))
+                else:
+                    self._healed = False
+                    
+
+    def write_shard(self, name):
+        with self.atomic(self.shard_path(name)) as conf:
+            JsonWriter(conf, self.compact).write({ 'sorted':True }, ( event.node for event in self._shards[name] ))
+            
+    def write_manifest(self):
+        node = dict(self.manifest)
+        node.pop('current', None)
+        if self.current is not None:
+            node['current'] = self.current.node
+        with self.atomic(self.manifest_path) as conf:
+            JsonWriter(conf, self.compact).write(node)
+            
+    def stale(self):
+        with self.locked(self.lock_path, fcntl.LOCK_SH) as lock:
+            return self.version(lock) != self._version
+            
+    def shard_of(self, event):
+        return event.order.strftime(shard_format['period'][self.manifest['period']])
+        
+    def shard_path(self, name):
+        return os.path.join(self.path, name + shard_format['suffix'])
+        
+    @property
+    def entries(self):
+        return (self.manifest is not None and self.manifest['shards']) or []
+        
+    @property
+    def slack(self):
+        return max([ entry['slack'] for entry in self.entries ] + [ 0 ])
+        
+    @property
+    def columns(self):
+        # columns over the whole history would read every shard a query prunes
+        return None
+        
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, shard_format['manifest'])
+        
+    @property
+    def lock_path(self):
+        return os.path.join(self.path, shard_format['lock'])
+        
+
+
+class SqliteStorage(Storage):
+    def __init__(self, project):
+        Storage.__init__(self, project)
+        self.connection = None
+        self._slack = None
+        self._version = 0
+        self._history = None
+        self._queue = []
+        
+    def open(self):
+        path = self.path
+        if self.varify_directory(os.path.dirname(path)):
+            try:
+                with profiler.phase('read'):
+                    self.connection = sqlite3.connect(path)
+                    self.create()
+                    version = self.connection.execute(
+                        'SELECT version FROM version WHERE project = ?',
+                        (self.name,)
+                    ).fetchone()
+                    row = self.connection.execute(
+                        'SELECT start, precision, rate, comment FROM running WHERE project = ?',
+                        (self.name,)
+                    ).fetchone()
+            except sqlite3.Error as err:
+                self.log.warning(u'Failed to open SQLite database for %s at %s', self.name, path)
+                self.log.debug(u'Exception raised %s', unicode(err))
+                self.connection = None
+            else:
+                if row is not None:
+                    self.current = decode_event(self.project, binary_format['type']['shift'], row[0], None, row[1], row[2], None, row[3])
+                self._version = (version is not None and version[0]) or 0
+                
+    def create(self):
+        # a writer creating the tables concurrently fails statements prepared against the old schema, once it is reloaded they pass
+        for attempt in range(8):
+            try:
+                if self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'version'").fetchone() is None:
+                    self.connection.executescript(sqlite_format['schema'])
+                break
+            except sqlite3.OperationalError as err:
+                if attempt == 7:
+                    raise
+                self.log.debug(u'Exception raised %s', unicode(err))
+                
+    def encode(self, event):
+        if isinstance(event, Shift):
+            return (
+                self.name,
+                binary_format['type']['shift'],
+                datetime_to_microseconds(event.start),
+                datetime_to_microseconds(event.end),
+                int(event.precision.total_seconds()),
+                event.rate,
+                None,
+                event.comment,
+                datetime_to_microseconds(event.round_start),
+                datetime_to_microseconds(event.round_end),
+                event.value,
+            )
+        else:
+            return (
+                self.name,
+                binary_format['type']['payment'],
+                datetime_to_microseconds(event.date),
+                None,
+                None,
+                None,
+                event.value,
+                event.comment,
+                None,
+                None,
+                event.value,
+            )
+            
+    def window(self, start, end):
+        # the index on project and start narrows the scan, rounding is covered by the slack
+        clause = [ 'project = ?' ]
+        parameters = [ self.name ]
+        if start is not None:
+            clause.append('start >= ?')
+            parameters.append(datetime_to_microseconds(start) - self.slack)
+        if end is not None:
+            clause.append('start <= ?')
+            parameters.append(datetime_to_microseconds(end) + self.slack)
+        return clause, parameters
+        
+    def select(self, start, end):
+        clause, parameters = self.window(start, end)
+        for row in self.connection.execute(
+            'SELECT type, start, stop, precision, rate, amount, comment FROM event WHERE {} ORDER BY start, id'.format(' AND '.join(clause)),
+            parameters
+        ):
+            yield decode_event(self.project, *row)
+            
+    def load(self, start=None, end=None):
+        if start is None and end is None and self._history is not None:
+            return self._history
+            
+        history = []
+        if self.connection is not None:
+            history = list(self.select(start, end))
+            
+        if start is None and end is None:
+            self._history = history
+        return history
+        
+    def stream(self, start=None, end=None):
+        if self.connection is None or (start is None and end is None and self._history is not None):
+            return self.load(start, end)
+        return self.select(start, end)
+        
+    def append(self, event):
+        # writes wait in the queue for flush, a transaction opened now would lock out every other writer until then
+        self._queue.append((
+            'INSERT INTO event (project, type, start, stop, precision, rate, amount, comment, round_start, round_end, value) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            self.encode(event)
+        ))
+        if self._slack is not None and isinstance(event, Shift) and abs(int(event.precision.total_seconds())) * 1000000 > self._slack:
+            self._slack = abs(int(event.precision.total_seconds())) * 1000000
+        if event is self.current:
+            self.update(None)
+        self._history = None
+        self._columns = None
+        self.volatile = True
+        
+    def update(self, shift):
+        if shift is None:
+            self._queue.append(('DELETE FROM running WHERE project = ?', (self.name,)))
+        else:
+            self._queue.append((
+                'INSERT OR REPLACE INTO running (project, start, precision, rate, comment) VALUES (?, ?, ?, ?, ?)',
+                (self.name, datetime_to_microseconds(shift.start), int(shift.precision.total_seconds()), shift.rate, shift.comment)
+            ))
+        self.current = shift
+        self.volatile = True
+        
+    def replace(self, current, history):
+        self._queue.append(('DELETE FROM event WHERE project = ?', (self.name,)))
+        self._slack = 0
+        for event in history:
+            self.append(event)
+        self.update(current)
+        
+    def flush(self):
+        if self.volatile and self.connection is not None:
+            self.log.debug(u'Committing SQLite database for %s', self.name)
+            try:
+                # the queued writes take the database lock, so the version can not move between this check and the commit
+                for statement, parameters in self._queue:
+                    self.connection.execute(statement, parameters)
+                cursor = self.connection.execute(
+                    'UPDATE version SET version = version + 1 WHERE project = ? AND version = ?',
+                    (self.name, self._version)
+                )
+                if cursor.rowcount == 0 and self._version == 0:
+                    cursor = self.connection.execute('INSERT OR IGNORE INTO version (project, version) VALUES (?, 1)', (self.name,))
+                    
+                if cursor.rowcount == 0:
+                    self.log.debug(u'Database for %s moved past version %d', self.name, self._version)
+                    self.connection.rollback()
+                    return False
+                    
+                self.connection.commit()
+            except sqlite3.Error as err:
+                self.log.warning(u'Failed to commit SQLite database for %s', self.name)
+                self.log.debug(u'Exception raised %s', unicode(err))
+                try:
+                    self.connection.rollback()
+                except sqlite3.Error as err:
+                    self.log.debug(u'Exception raised %s', unicode(err))
+                return False
+            else:
+                self._queue = []
+                self._version += 1
+                self.volatile = False
+        return True
+        
+    @property
+    def digest_path(self):
+        # projects share the database, each has its own index
+        return u'{}.{}.digests'.format(self.path, self.name)
+        
+    @property
+    def slack(self):
+        # scanning every shift is left to the first windowed query, start and stop never need it
+        if self._slack is None:
+            row = self.connection.execute(
+                'SELECT MAX(ABS(precision)) FROM event WHERE project = ? AND type = 0',
+                (self.name,)
+            ).fetchone()
+            self._slack = (row[0] or 0) * 1000000
+        return self._slack
+        
+    def stale(self):
+        result = False
+        if self.connection is not None:
+            version = self.connection.execute('SELECT version FROM version WHERE project = ?', (self.name,)).fetchone()
+            result = ((version is not None and version[0]) or 0) != self._version
+        return result
+        
+    def aggregate(self, start, end):
+        total = None
+        if self.connection is not None:
+            clause, parameters = self.window(start, end)
+            shift = [ 'type = 0' ]
+            payment = [ 'type = 1' ]
+            if start is not None:
+                shift.append('round_start > ?')
+                payment.append('start > ?')
+            if end is not None:
+                shift.append('round_start < ?')
+                payment.append('start < ?')
+            bound = [ datetime_to_microseconds(b) for b in (start, end) if b is not None ]
+            clause.append('(({}) OR ({}))'.format(' AND '.join(shift), ' AND '.join(payment)))
+            clause = ' AND '.join(clause)
+            row = self.connection.execute(sqlite_format['aggregate'].format(clause), parameters + bound + bound).fetchone()
+            total = {
+                'shift':row[0],
+                'payment':row[1],
+                'early':(row[2] is not None and microseconds_to_datetime(row[2])) or None,
+                'late':(row[3] is not None and microseconds_to_datetime(row[3])) or None,
+                'duration':timedelta(microseconds=row[4]),
+                'labour':0.0,
+                'deposit':0.0,
+                'balance':0.0,
+                'opening':None,
+            }
+            
+            # money is summed here in event order, so rounding matches the other backends
+            for year, month, kind, duration, value in self.connection.execute(sqlite_format['ledger'].format(clause), parameters + bound + bound):
+                if kind == binary_format['type']['shift']:
+                    total['labour'] += value
+                    total['balance'] += value
+                else:
+                    total['deposit'] += value
+                    total['balance'] -= value
+                    
+            if start is not None:
+                total['opening'] = self.opening(start)
+        return total
+        
+    def opening(self, start):
+        # the balance of everything at or before the start, summed in event order like the window
+        clause, parameters = self.window(None, start)
+        clause.append('((type = 0 AND round_start <= ?) OR (type = 1 AND start <= ?))')
+        bound = datetime_to_microseconds(start)
+        balance = 0.0
+        for year, month, kind, duration, value in self.connection.execute(sqlite_format['ledger'].format(' AND '.join(clause)), parameters + [ bound, bound ]):
+            if kind == binary_format['type']['shift']:
+                balance += value
+            else:
+                balance -= value
+        return balance
+        
+    def tabulate(self, start, end):
+        total = None
+        if self.connection is not None:
+            clause = [ 'project = ?' ]
+            parameters = [ self.name ]
+            if start is not None:
+                clause.append('start > ?')
+                parameters.append(datetime_to_microseconds(start))
+            if end is not None:
+                clause.append('start < ?')
+                parameters.append(datetime_to_microseconds(end))
+                
+            total = { 'balance':0.0, 'year':{}, }
+            for year, month, kind, duration, value in self.connection.execute(sqlite_format['ledger'].format(' AND '.join(clause)), parameters):
+                if year not in total['year']:
+                    total['year'][year] = {}
+                    
+                if month not in total['year'][year]:
+                    total['year'][year][month] = { 'duration':timedelta(), 'value':0.0, 'balance':None }
+                    
+                record = total['year'][year][month]
+                if kind == binary_format['type']['shift']:
+                    total['balance'] += value
+                    record['duration'] += timedelta(microseconds=duration)
+                    record['value'] += value
+                else:
+                    total['balance'] -= value
+                record['balance'] = total['balance']
+        return total
+        
+
+
+class Event(object):
+    __slots__ = ('project', 'balance', '_node', '_comment')
+    log = logging.getLogger('event')
+    
+    def __init__(self, project, node=None):
+        self.project = project
+        self.balance = None
+        self._comment = None
+        self._node = node
+        
+    def decode(self):
+        # the raw node is parsed on first access and then dropped
+        node = self._node
+        self._node = None
+        if 'comment' in node:
+            self.comment = node['comment'] or None
+        return node
+        
+    @property
+    def type(self):
+        return None
+        
+    @property
+    def node(self):
+        result = {}
+        return result
+        
+    @property
+    def date(self):
+        return None
+        
+    @property
+    def comment(self):
+        if self._node is not None:
+            self.decode()
+        return self._comment
         
     @comment.setter
     def comment(self, value):
-        self._node['comment'] = value
+        if self._node is not None:
+            self.decode()
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        self._comment = value
+        
+    @property
+    def env(self):
+         return self.project.env
+         
+    @property
+    def json(self):
+         return json.dumps(self.node, ensure_ascii=False, sort_keys=True, indent=4,  default=default_json_handler).encode('utf-8')
+         
+
+
+class Shift(Event):
+    __slots__ = ('_start', '_end', '_precision', '_rate', '_round_start', '_round_end', '_round_duration', '_value')
+    
+    def __init__(self, project, node=None):
+        # nothing is set yet for __setattr__ to guard, so the slots are filled directly
+        assign = object.__setattr__
+        for name in Shift.__slots__:
+            assign(self, name, None)
+        Event.__init__(self, project, node)
+        
+    def __setattr__(self, name, value):
+        if name in ('_start', '_end', '_precision', '_rate'):
+            # an assigned value must not be overwritten by the raw node later
+            if getattr(self, '_node', None) is not None:
+                self.decode()
+                
+            # derived values are cached, so replacing a value they derive from drops them
+            if getattr(self, name, None) is not None:
+                self.invalidate()
+        object.__setattr__(self, name, value)
+        
+    def decode(self):
+        node = Event.decode(self)
+        if 'start' in node:
+            self._start = parse_datetime(node['start'])
+        if 'end' in node:
+            self._end = parse_datetime(node['end'])
+        if 'precision' in node:
+            self._precision = timedelta(seconds=node['precision'])
+        if 'rate' in node:
+            self._rate = node['rate']
+        return node
+        
+    def invalidate(self):
+        self._round_start = None
+        self._round_end = None
+        self._round_duration = None
+        self._value = None
+        
+    def row(self, renderer):
+        return (
+            self.type,
+            renderer.date(self.round_start),
+            renderer.date(self.round_end),
+            unicode(self.round_duration),
+            self.value,
+            self.balance,
+            self.comment
+        )
+        
+    def report(self):
+        if self.running:
+            print ''
+            print_running(self.start, self.duration, self.comment)
+        else:
+            print expression['csv record pattern'].format (
+                datetime.strftime(self.round_start, expression['csv datetime format']),
+                datetime.strftime(self.round_end, expression['csv datetime format']),
+                unicode(self.round_duration),
+                self.value,
+                self.balance
+            )
+            
+    @property
+    def running(self):
+        return self.start is not None and self.end is None
+        
+    @property
+    def node(self):
+        result = {}
+        result['type'] = 'shift'
+        if self.start is not None:
+            result['start'] = datetime.strftime(self.start, expression['datetime format'])
+        if self.end is not None:
+            result['end'] = datetime.strftime(self.end, expression['datetime format'])
+        if self.precision is not None:
+            result['precision'] = int(self.precision.total_seconds())
+        if self.comment is not None:
+            result['comment'] = self.comment
+        if self.rate is not None:
+            result['rate'] = self.rate
+        return result
+        
+    @property
+    def type(self):
+        return 'shift'
+        
+    @property
+    def date(self):
+        return self.start
+        
+    @property
+    def start(self):
+        if self._node is not None:
+            self.decode()
+        return self._start
+        
+    @property
+    def end(self):
+        if self._node is not None:
+            self.decode()
+        return self._end
+        
+    @property
+    def precision(self):
+        if self._node is not None:
+            self.decode()
+        return self._precision
+        
+    @property
+    def duration(self):
+        if self.running:
+            return datetime.now() - self.start
+        elif self.start is not None and self.end is not None:
+            return self.end - self.start
+        else:
+            return None
+            
+    @property
+    def rate(self):
+        if self._node is not None:
+            self.decode()
+        if self._rate is None:
+            self._rate = self.project.config['rate']
+        return self._rate
+            
+    @property
+    def value(self):
+        if self.running:
+            return round((float(self.round_duration.total_seconds()) / 3600.0),2) * self.rate
+        elif self._value is None:
+            self._value = round((float(self.round_duration.total_seconds()) / 3600.0),2) * self.rate
+        return self._value
         
     @property
-    def env(self):
-         return self.project.env
-         
+    def round_start(self):
+        if self._round_start is None and self.start is not None and self.precision is not None:
+            self._round_start = round_datetime_to_timedelta(self.start, self.precision)
+        return self._round_start
+        
     @property
-    def json(self):
-         return json.dumps(self.node, ensure_ascii=False, sort_keys=True, indent=4,  default=default_json_handler).encode('utf-8')
-         
+    def round_end(self):
+        if self._round_end is None and self.end is not None and self.precision is not None:
+            self._round_end = round_datetime_to_timedelta(self.end, self.precision)
+        return self._round_end
+        
+    @property
+    def round_duration(self):
+        if self.running:
+            return round_datetime_to_timedelta(datetime.now(), self.precision) - self.start
+        elif self._round_duration is None and self.round_start is not None and self.round_end is not None:
+            self._round_duration = self.round_end - self.round_start
+        return self._round_duration
+            
+    @property
+    def order(self):
+        return self.start
+        
 
 
-class Shift(Event):
-    def __init__(self, project, node={}):
+class Payment(Event):
+    __slots__ = ('_date', '_amount')
+    
+    def __init__(self, project, node=None):
         Event.__init__(self, project, node)
-        self._start = None
-        self._end = None
-        self._precision = None
-        self._rate = None
+        self._date = None
+        self._amount = None
         
-    def print_balance(self):
-        print expression['csv record pattern'].format (
+    def decode(self):
+        node = Event.decode(self)
+        if 'date' in node:
+            self._date = parse_datetime(node['date'])
+        if 'amount' in node:
+            self._amount = node['amount']
+        return node
+        
+    @property
+    def node(self):
+        result = {}
+        result['type'] = 'payment'
+        result['amount'] = self.value
+        result['date'] = datetime.strftime(self.date, expression['datetime format'])
+        if self.comment is not None:
+            result['comment'] = self.comment
+        return result
+        
+    def row(self, renderer):
+        return (
             self.type,
-            datetime.strftime(self.round_start, expression['csv datetime format']),
-            datetime.strftime(self.round_end, expression['csv datetime format']),
-            unicode(self.round_duration),
+            renderer.date(self.date),
+            '',
+            '',
             self.value,
             self.balance,
             self.comment
         )
         
     def report(self):
-        if self.running:
-            print ''
-            print expression['current record pattern'].format (
-                datetime.strftime(self.start, expression['csv datetime format']),
-                unicode(self.duration),
-            )
-            if self.comment:
-                print self.comment
+        print expression['csv record pattern'].format (
+            datetime.strftime(self.date, expression['csv datetime format']),
+            '',
+            '',
+            self.value,
+            self.balance
+        )
+        
+    @property
+    def type(self):
+        return 'payment'
+        
+    @property
+    def date(self):
+        if self._node is not None:
+            self.decode()
+        return self._date
+        
+    @property
+    def value(self):
+        if self._node is not None:
+            self.decode()
+        return self._amount
+        
+    @property
+    def order(self):
+        return self.date
+        
+
+
+class Rollup(object):
+    def __init__(self, node=None):
+        self.log = logging.getLogger('rollup')
+        self.snapshot = None
+        self.journal = 0
+        self.month = []
+        self.volatile = False
+        self.last = None
+        self._key = []
+        if node is not None:
+            self.snapshot = node['snapshot']
+            self.journal = node['journal']
+            self.last = node.get('last')
+            for record in node['month']:
+                self._key.append((record['year'], record['month']))
+                self.month.append(record)
+                
+    def add(self, event):
+        if event.date:
+            key = (event.date.year, event.date.month)
+            position = bisect.bisect_left(self._key, key)
+            if position == len(self._key) or self._key[position] != key:
+                balance = 0.0
+                if position > 0:
+                    balance = self.month[position - 1]['balance']
+                self._key.insert(position, key)
+                self.month.insert(position, {
+                    'year':key[0],
+                    'month':key[1],
+                    'duration':0,
+                    'value':0.0,
+                    'payments':0.0,
+                    'balance':balance,
+                })
+                
+            record = self.month[position]
+            if isinstance(event, Shift):
+                signed = event.value
+                record['duration'] += delta_to_microseconds(event.duration)
+                record['value'] += event.value
+                
+            elif isinstance(event, Payment):
+                signed = -event.value
+                record['payments'] += event.value
+                
+            # the closing balance of every later month moves too
+            for record in self.month[position:]:
+                record['balance'] += signed
+            self.last = max(self.last, datetime_to_microseconds(event.order))
+            self.volatile = True
+            
+    def follows(self, event):
+        # folded in after a later event the sums take another order than a rebuild from history, and may differ in the last bits
+        if event.date is None:
+            return True
+        if self.last is None:
+            return not self.month
+        return datetime_to_microseconds(event.order) >= self.last
+        
+    @property
+    def total(self):
+        total = {
+            'year':{},
+        }
+        for record in self.month:
+            if record['year'] not in total['year']:
+                total['year'][record['year']] = {}
+                
+            total['year'][record['year']][record['month']] = {
+                'duration':timedelta(microseconds=record['duration']),
+                'value':record['value'],
+                'balance':record['balance'],
+            }
+        return total
+        
+    @property
+    def node(self):
+        return {
+            'snapshot':self.snapshot,
+            'journal':self.journal,
+            'last':self.last,
+            'month':self.month,
+        }
+        
+
+
+class Prefix(object):
+    def __init__(self, stream=None):
+        self.log = logging.getLogger('prefix')
+        self.snapshot = None
+        self.journal = 0
+        self.slack = 0
+        self.capacity = 1
+        self.volatile = False
+        for name, code in prefix_format['event']:
+            setattr(self, name, array(code))
+        for name, code in prefix_format['running']:
+            setattr(self, name, array(code, [0]))
+        for name, code in prefix_format['tree']:
+            setattr(self, name, array(code, [prefix_format['null'][name]]) * 2)
+        if stream is not None:
+            self.read(stream)
+            
+    def read(self, stream):
+        header = stream.read(prefix_format['header'].size)
+        magic, version, width, size, mtime, journal, count, capacity, slack = prefix_format['header'].unpack(header)
+        if magic != prefix_format['magic'] or version != prefix_format['version'] or width != self.order.itemsize:
+            raise ValueError('not a prefix index')
+            
+        self.snapshot = (size >= 0 and [ size, mtime ]) or None
+        self.journal = journal
+        self.capacity = capacity
+        self.slack = slack
+        for name, code in prefix_format['event']:
+            column = array(code)
+            column.fromfile(stream, count)
+            setattr(self, name, column)
+        for name, code in prefix_format['running']:
+            column = array(code)
+            column.fromfile(stream, count + 1)
+            setattr(self, name, column)
+        for name, code in prefix_format['tree']:
+            column = array(code)
+            column.fromfile(stream, capacity * 2)
+            setattr(self, name, column)
+            
+    def write(self, stream):
+        size, mtime = self.snapshot or (-1, 0.0)
+        stream.write(prefix_format['header'].pack(
+            prefix_format['magic'],
+            prefix_format['version'],
+            self.order.itemsize,
+            size,
+            mtime,
+            self.journal,
+            len(self.order),
+            self.capacity,
+            self.slack,
+        ))
+        for section in ('event', 'running', 'tree'):
+            for name, code in prefix_format[section]:
+                getattr(self, name).tofile(stream)
+                
+    def add(self, event):
+        self.extend([ event ])
+        
+    def extend(self, events):
+        # running sums after a backdated event are settled once, however many events came before it
+        moved = None
+        for event in events:
+            position = self.insert(event)
+            if position is None:
+                continue
+                
+            elif moved is None and position + 1 == len(self.order) and position < self.capacity:
+                self.settle(position)
+                self.raise_leaf(position)
+                
+            elif moved is None or position < moved:
+                moved = position
+                
+        if moved is not None:
+            self.settle(moved)
+            self.build()
+        return moved
+        
+    def insert(self, event):
+        if isinstance(event, Shift):
+            kind = binary_format['type']['shift']
+            key = datetime_to_microseconds(event.round_start)
+            late = datetime_to_microseconds(event.round_end)
+            duration = delta_to_microseconds(event.round_duration)
+            self.slack = max(self.slack, delta_to_microseconds(abs(event.precision)))
+            
+        elif isinstance(event, Payment):
+            kind = binary_format['type']['payment']
+            key = datetime_to_microseconds(event.date)
+            late = key
+            duration = 0
         else:
-            print expression['csv record pattern'].format (
-                datetime.strftime(self.round_start, expression['csv datetime format']),
-                datetime.strftime(self.round_end, expression['csv datetime format']),
-                unicode(self.round_duration),
-                self.value,
-                self.balance
-            )
+            return None
+            
+        # same position the history gives the event, so running sums add up in history order
+        order = datetime_to_microseconds(event.order)
+        position = bisect.bisect_right(self.order, order)
+        for name, value in zip(('order', 'key', 'late', 'kind', 'value', 'duration'), (order, key, late, kind, event.value, duration)):
+            getattr(self, name).insert(position, value)
+        for name, code in prefix_format['running']:
+            getattr(self, name).append(0)
+        return position
+        
+    def settle(self, position):
+        # an event appended last only touches the last entry, a backdated one moves everything after it
+        shift = binary_format['type']['shift']
+        kind, value, duration = self.kind, self.value, self.duration
+        shifts, payments, worked = self.shifts, self.payments, self.worked
+        labour, deposit, balance = self.labour, self.deposit, self.balance
+        for index in xrange(position, len(self.order)):
+            worked[index + 1] = worked[index] + duration[index]
+            if kind[index] == shift:
+                shifts[index + 1] = shifts[index] + 1
+                payments[index + 1] = payments[index]
+                labour[index + 1] = labour[index] + value[index]
+                deposit[index + 1] = deposit[index]
+                balance[index + 1] = balance[index] + value[index]
+            else:
+                shifts[index + 1] = shifts[index]
+                payments[index + 1] = payments[index] + 1
+                labour[index + 1] = labour[index]
+                deposit[index + 1] = deposit[index] + value[index]
+                balance[index + 1] = balance[index] - value[index]
+                
+    def build(self):
+        capacity = 1
+        while capacity < len(self.order):
+            capacity <<= 1
+        self.capacity = capacity
+        for name, column in (('lowest', self.key), ('highest', self.late)):
+            tree = array('l', [prefix_format['null'][name]]) * (capacity * 2)
+            tree[capacity:capacity + len(column)] = column
+            setattr(self, name, tree)
+        for index in xrange(capacity - 1, 0, -1):
+            self.lowest[index] = min(self.lowest[index * 2], self.lowest[index * 2 + 1])
+            self.highest[index] = max(self.highest[index * 2], self.highest[index * 2 + 1])
+            
+    def raise_leaf(self, position):
+        index = self.capacity + position
+        self.lowest[index] = self.key[position]
+        self.highest[index] = self.late[position]
+        index >>= 1
+        while index:
+            self.lowest[index] = min(self.lowest[index * 2], self.lowest[index * 2 + 1])
+            self.highest[index] = max(self.highest[index * 2], self.highest[index * 2 + 1])
+            index >>= 1
+            
+    def extreme(self, lower, upper):
+        lowest = prefix_format['null']['lowest']
+        highest = prefix_format['null']['highest']
+        lower += self.capacity
+        upper += self.capacity
+        while lower < upper:
+            if lower & 1:
+                lowest = min(lowest, self.lowest[lower])
+                highest = max(highest, self.highest[lower])
+                lower += 1
+            if upper & 1:
+                upper -= 1
+                lowest = min(lowest, self.lowest[upper])
+                highest = max(highest, self.highest[upper])
+            lower >>= 1
+            upper >>= 1
+        return lowest, highest
+        
+    def total(self, start, end):
+        count = len(self.order)
+        lower, first, last, upper = 0, 0, count, count
+        if start is not None:
+            start = datetime_to_microseconds(start)
+            lower = bisect.bisect_left(self.order, start - self.slack)
+            first = bisect.bisect_right(self.order, start + self.slack)
+        if end is not None:
+            end = datetime_to_microseconds(end)
+            last = bisect.bisect_left(self.order, end - self.slack)
+            upper = bisect.bisect_right(self.order, end + self.slack)
+        if first > last:
+            last = first
+            
+        # events between first and last are inside the window whatever their rounding,
+        # only the few near either bound are tested one by one
+        def inside(index):
+            return (start is None or self.key[index] > start) and (end is None or self.key[index] < end)
+        fringe = [ index for index in xrange(lower, first) if inside(index) ] + [ index for index in xrange(last, upper) if inside(index) ]
+        
+        lowest, highest = self.extreme(first, last)
+        total = {
+            'duration':self.worked[last] - self.worked[first],
+            'shift':self.shifts[last] - self.shifts[first],
+            'payment':self.payments[last] - self.payments[first],
+            'early':None,
+            'late':None,
+            'labour':0.0,
+            'deposit':0.0,
+            'balance':0.0,
+            'opening':None,
+        }
+        for index in fringe:
+            total['duration'] += self.duration[index]
+            if self.kind[index] == binary_format['type']['shift']:
+                total['shift'] += 1
+            else:
+                total['payment'] += 1
+            lowest = min(lowest, self.key[index])
+            highest = max(highest, self.late[index])
+        total['duration'] = timedelta(microseconds=total['duration'])
+        
+        if total['shift'] or total['payment']:
+            total['early'] = microseconds_to_datetime(lowest)
+            total['late'] = microseconds_to_datetime(highest)
+            
+        # a running sum read off the index only rounds like the event loop when it starts at the first event,
+        # a window opening later is added up again over the value column
+        if start is None:
+            total['labour'] = self.labour[last]
+            total['deposit'] = self.deposit[last]
+            total['balance'] = self.balance[last]
+            fringe = [ index for index in fringe if index >= last ]
+        else:
+            fringe = [ index for index in xrange(lower, upper) if (first <= index < last) or inside(index) ]
+            
+        for index in fringe:
+            value = self.value[index]
+            if self.kind[index] == binary_format['type']['shift']:
+                total['labour'] += value
+                total['balance'] += value
+            else:
+                total['deposit'] += value
+                total['balance'] -= value
+                
+        if start is not None:
+            # the balance carried into the window, everything at or before its start
+            total['opening'] = self.balance[lower]
+            for index in xrange(lower, first):
+                if self.key[index] <= start:
+                    if self.kind[index] == binary_format['type']['shift']:
+                        total['opening'] += self.value[index]
+                    else:
+                        total['opening'] -= self.value[index]
+        return total
+        
+
+
+class Digests(object):
+    def __init__(self, stream=None):
+        # an open addressing table of 64 bit content digests, zero marks a free slot
+        self.version = None
+        self.count = 0
+        self.table = array('L', [0]) * digest_format['capacity']
+        self.volatile = False
+        if stream is not None:
+            self.read(stream)
+            
+    def read(self, stream):
+        layout = digest_format['header']
+        magic, version, size, self.version, self.count, capacity = layout.unpack(stream.read(layout.size))
+        if magic != digest_format['magic'] or version != digest_format['version'] or size != self.table.itemsize:
+            raise ValueError(u'not a bill digest index')
+        self.table = array('L')
+        self.table.fromfile(stream, capacity)
+        
+    def write(self, stream):
+        stream.write(digest_format['header'].pack(digest_format['magic'], digest_format['version'], self.table.itemsize, self.version or 0, self.count, len(self.table)))
+        self.table.tofile(stream)
+        
+    def add(self, digest):
+        # False when the digest is known already
+        table = self.table
+        mask = len(table) - 1
+        slot = digest & mask
+        while table[slot]:
+            if table[slot] == digest:
+                return False
+            slot = (slot + 1) & mask
+        table[slot] = digest
+        self.count += 1
+        self.volatile = True
+        
+        # probes stay short while the table is at most half full
+        if self.count * 2 > len(table):
+            self.grow()
+        return True
+        
+    def grow(self):
+        table = self.table
+        self.table = array('L', [0]) * (len(table) * 2)
+        self.count = 0
+        for digest in table:
+            if digest:
+                self.add(digest)
+                
+    def __len__(self):
+        return self.count
+        
+
+
+class Records(object):
+    def __init__(self, path):
+        self.log = logging.getLogger('records')
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.flags, self.count, self.table = binary_format['header'].unpack_from(self.map, 0)
+        if magic != binary_format['magic'] or version != binary_format['version']:
+            self.close()
+            raise ValueError(u'{} is not a bill database'.format(path))
+            
+        if len(self.map) < self.offset(self.count) or len(self.map) < self.table:
+            self.close()
+            raise ValueError(u'{} is truncated'.format(path))
+            
+    def __len__(self):
+        return self.count
+        
+    def __iter__(self):
+        record = binary_format['record']
+        for index in xrange(self.count):
+            yield record.unpack_from(self.map, self.offset(index))
+            
+    def offset(self, index):
+        # the current shift occupies the slot in front of the history
+        return binary_format['header'].size + binary_format['record'].size * (index + 1)
+        
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+        
+    def string(self, offset, length):
+        if length == binary_format['null']['string']:
+            return None
+        else:
+            return self.map[self.table + offset:self.table + offset + length].decode('utf-8')
             
+    def comment(self, index):
+        values = binary_format['record'].unpack_from(self.map, self.offset(index))
+        return self.string(values[6], values[7])
+        
+    def event(self, project, values):
+        start, end, precision, rate, amount, kind, offset, length = values
+        if start == binary_format['null']['time']: start = None
+        if end == binary_format['null']['time']: end = None
+        if precision == binary_format['null']['precision']: precision = None
+        if math.isnan(rate): rate = None
+        return decode_event(project, kind, start, end, precision, rate, amount, self.string(offset, length))
+        
     @property
-    def running(self):
-        return self.start is not None and self.end is None
+    def sorted(self):
+        return bool(self.flags & binary_format['flag']['sorted'])
+        
+    @property
+    def current(self):
+        if self.flags & binary_format['flag']['current']:
+            return binary_format['record'].unpack_from(self.map, binary_format['header'].size)
+        return None
+        
+    @property
+    def array(self):
+        layout = numpy.dtype([
+            ('start', '<i8'),
+            ('end', '<i8'),
+            ('precision', '<i4'),
+            ('rate', '<f8'),
+            ('amount', '<f8'),
+            ('type', 'u1'),
+            ('offset', '<u4'),
+            ('length', '<u4'),
+            ('pad', 'V3'),
+        ])
+        return numpy.frombuffer(self.map, dtype=layout, count=self.count, offset=self.offset(0))
+        
+
+
+class JsonStream(object):
+    def __init__(self, path, size=65536, file=None):
+        self.log = logging.getLogger('stream')
+        self.path = path
+        self.size = size
+        self.decoder = json.JSONDecoder()
+        self.held = file
+        self.file = None
+        self.buffer = ''
+        self.position = 0
+        
+    def __iter__(self):
+        # yields the keys of the top level object in file order,
+        # the elements of the history array are yielded one at a time,
+        # a file handed in is read from its start and left open
+        if self.held is not None:
+            self.file = self.held
+            self.file.seek(0)
+        else:
+            self.file = open(self.path, 'r')
+        try:
+            self.expect('{')
+            while self.peek() != '}':
+                key = self.value()
+                self.expect(':')
+                if key == 'history':
+                    self.expect('[')
+                    while self.peek() != ']':
+                        yield key, self.value()
+                        self.separate(']')
+                    self.expect(']')
+                else:
+                    yield key, self.value()
+                self.separate('}')
+        finally:
+            if self.file is not self.held:
+                self.file.close()
+            
+    def fill(self):
+        data = self.file.read(self.size)
+        if data:
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+            return True
+        return False
+        
+    def peek(self):
+        while True:
+            self.position = expression['json whitespace'].match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+                
+            elif not self.fill():
+                raise ValueError(u'Unexpected end of {}'.format(self.path))
+                
+    def expect(self, token):
+        if self.peek() != token:
+            raise ValueError(u'Expecting {} in {}'.format(token, self.path))
+        self.position += 1
+        
+    def separate(self, close):
+        token = self.peek()
+        if token == ',':
+            self.position += 1
+        elif token != close:
+            raise ValueError(u'Expecting , or {} in {}'.format(close, self.path))
+            
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if not self.fill():
+                    raise
+            else:
+                # a value is complete once a delimiter follows it, a number may go on in the next chunk
+                following = expression['json whitespace'].match(self.buffer, end).end()
+                if (following < len(self.buffer) and self.buffer[following] in ',:]}') or not self.fill():
+                    self.position = end
+                    return value
+                    
+
+
+class JsonWriter(object):
+    def __init__(self, file, compact=False, digest=False, size=json_format['chunk']):
+        self.log = logging.getLogger('writer')
+        self.file = file
+        self.size = size
+        self.layout = json_format[compact and 'compact' or 'pretty']
+        self.encoder = json.JSONEncoder(ensure_ascii=False, default=default_json_handler, **self.layout)
+        self.hash = (digest and hashlib.sha1()) or None
+        self.buffer = []
+        self.length = 0
+        
+    def write(self, node, history=None):
+        # the same text json.dumps makes of node with history added, but the history may be any iterable
+        # and is never held whole. keys always come sorted at the top level,
+        # readers look for current before the history and for the sorted flag at the end of the file
+        keys = sorted(node.keys() + (history is not None and ['history'] or []))
+        if keys:
+            self.emit(u'{')
+            for index, key in enumerate(keys):
+                if index: self.emit(self.separator)
+                self.emit(self.newline(1))
+                self.emit(self.encoder.encode(key))
+                self.emit(self.layout['separators'][1])
+                if key == 'history' and history is not None:
+                    self.array(history, 2)
+                else:
+                    self.emit(self.encode(node[key], 1))
+            self.emit(self.newline(0))
+            self.emit(u'}')
+        else:
+            self.emit(u'{}')
+        self.flush()
+        
+    def array(self, values, level):
+        # values are encoded a batch at a time, a call to the encoder costs about as much as a small value
+        values = iter(values)
+        batch = list(islice(values, json_format['batch']))
+        if batch:
+            self.emit(u'[')
+            while batch:
+                # each batch is an array of its own, its brackets and the line break before the closing one are dropped
+                text = self.encode(batch, level - 1)
+                self.emit(text[1:len(text) - len(self.newline(level - 1)) - 1])
+                batch = list(islice(values, json_format['batch']))
+                if batch: self.emit(self.separator)
+            self.emit(self.newline(level - 1))
+            self.emit(u']')
+        else:
+            self.emit(u'[]')
+            
+    def encode(self, value, level):
+        # nested lines move in by the level, JSON strings never hold a raw line break
+        text = self.encoder.encode(value)
+        if self.layout['indent'] is not None:
+            text = text.replace(u'\n', self.newline(level))
+        return text
+        
+    def emit(self, text):
+        self.buffer.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+            
+    def flush(self):
+        if self.buffer:
+            chunk = u''.join(self.buffer).encode('utf-8')
+            self.file.write(chunk)
+            if self.hash is not None:
+                self.hash.update(chunk)
+            self.buffer = []
+            self.length = 0
+            
+    def newline(self, level):
+        if self.layout['indent'] is not None:
+            return u'\n' + u' ' * (self.layout['indent'] * level)
+        return u''
+        
+    @property
+    def separator(self):
+        return self.layout['separators'][0]
+        
+    @property
+    def digest(self):
+        if self.hash is not None:
+            return self.hash.hexdigest()
+        return None
+        
+
+
+class Columns(object):
+    def __init__(self, history=None, records=None):
+        self.log = logging.getLogger('columns')
+        self.records = records
+        if records is not None:
+            # scan the mapped records directly, copies keep the columns valid once the map closes
+            array = records.array
+            self.kind = array['type'].astype(numpy.int8)
+            self.start = array['start'].astype(numpy.int64)
+            self.end = array['end'].astype(numpy.int64)
+            self.precision = numpy.where(self.kind == 0, array['precision'], 1).astype(numpy.float64)
+            self.rate = numpy.where(self.kind == 0, array['rate'], 0.0)
+            self.amount = array['amount'].astype(numpy.float64)
+            
+        else:
+            kind = []
+            start = []
+            end = []
+            precision = []
+            rate = []
+            amount = []
+            self.comments = []
+            for event in history:
+                if isinstance(event, Shift):
+                    kind.append(0)
+                    start.append(datetime_to_microseconds(event.start))
+                    end.append(datetime_to_microseconds(event.end))
+                    precision.append(int(event.precision.total_seconds()))
+                    rate.append(event.rate)
+                    amount.append(0.0)
+                    
+                elif isinstance(event, Payment):
+                    kind.append(1)
+                    start.append(datetime_to_microseconds(event.date))
+                    end.append(start[-1])
+                    precision.append(1)
+                    rate.append(0.0)
+                    amount.append(event.value)
+                self.comments.append(event.comment)
+                
+            self.kind = numpy.array(kind, dtype=numpy.int8)
+            self.start = numpy.array(start, dtype=numpy.int64)
+            self.end = numpy.array(end, dtype=numpy.int64)
+            self.precision = numpy.array(precision, dtype=numpy.float64)
+            self.rate = numpy.array(rate, dtype=numpy.float64)
+            self.amount = numpy.array(amount, dtype=numpy.float64)
+            
+        self.shift = self.kind == 0
+        self.payment = self.kind == 1
+        
+        # derived columns, payments simply carry their date and amount
+        quant = numpy.rint(self.precision * 1e6).astype(numpy.int64)
+        self.round_start = numpy.where(self.shift, round_column(self.start, quant), self.start)
+        self.round_end = numpy.where(self.shift, round_column(self.end, quant), self.end)
+        self.round_duration = self.round_end - self.round_start
+        self.duration = self.end - self.start
+        self.value = numpy.where(self.shift, hours_column(self.round_duration) * self.rate, self.amount)
+        self.signed = numpy.where(self.shift, self.value, -self.value)
+        self.month = self.start.astype('datetime64[us]').astype('datetime64[M]').astype(numpy.int64)
+        self.slack = int(numpy.absolute(self.precision[self.shift]).max() * 1e6) if self.shift.any() else 0
+        self.log.debug(u'Built columns for %d events', len(self.kind))
+        
+    def scope(self, start, end):
+        # columns follow the sorted history, rounding moves a shift by less than the slack
+        lower = 0
+        upper = len(self.kind)
+        if start is not None:
+            lower = int(numpy.searchsorted(self.start, datetime_to_microseconds(start) - self.slack, side='left'))
+        if end is not None:
+            upper = int(numpy.searchsorted(self.start, datetime_to_microseconds(end) + self.slack, side='right'))
+        return lower, upper
+        
+    def select(self, column, lower, upper, start, end):
+        mask = numpy.ones(upper - lower, dtype=bool)
+        if start is not None:
+            mask &= column[lower:upper] > datetime_to_microseconds(start)
+        if end is not None:
+            mask &= column[lower:upper] < datetime_to_microseconds(end)
+        return mask
+        
+    def window(self, start, end):
+        # shifts are filtered by their rounded start, payments by their date
+        lower, upper = self.scope(start, end)
+        mask = numpy.where(self.shift[lower:upper], self.select(self.round_start, lower, upper, start, end), self.select(self.start, lower, upper, start, end))
+        return numpy.flatnonzero(mask) + lower
+        
+    def report(self, start, end):
+        index = self.window(start, end)
+        shift = index[self.shift[index]]
+        payment = index[self.payment[index]]
+        total = {
+            'duration':timedelta(microseconds=int(self.round_duration[shift].sum())),
+            'shift':len(shift),
+            'payment':len(payment),
+            'early':None,
+            'late':None,
+            'labour':accumulate(self.value[shift]),
+            'deposit':accumulate(self.value[payment]),
+            'balance':accumulate(self.signed[index]),
+            'opening':None,
+        }
+        if len(index):
+            total['early'] = microseconds_to_datetime(self.round_start[index].min())
+            total['late'] = microseconds_to_datetime(self.round_end[index].max())
+            
+        if start is not None:
+            # everything at or before the start carries its balance into the window
+            lower, upper = self.scope(None, start)
+            key = numpy.where(self.shift[:upper], self.round_start[:upper], self.start[:upper])
+            total['opening'] = accumulate(self.signed[:upper][key <= datetime_to_microseconds(start)])
+        return total
+        
+    def monthly(self, start, end):
+        total = {
+            'year':{},
+        }
+        lower, upper = self.scope(start, end)
+        index = numpy.flatnonzero(self.select(self.start, lower, upper, start, end)) + lower
+        if len(index):
+            balance = numpy.add.accumulate(numpy.concatenate(([0.0], self.signed[index])))[1:]
+            month = self.month[index]
+            
+            # stable sort keeps events in history order within each month
+            arrange = numpy.argsort(month, kind='mergesort')
+            key, first, count = numpy.unique(month, return_index=True, return_counts=True)
+            bounds = numpy.concatenate(([0], numpy.cumsum(count)))
+            
+            # emit months in order of first appearance, like the event loop does
+            for group in numpy.argsort(first, kind='mergesort'):
+                position = arrange[bounds[group]:bounds[group + 1]]
+                shift = index[position][self.shift[index[position]]]
+                year = int(key[group] // 12 + 1970)
+                if year not in total['year']:
+                    total['year'][year] = {}
+                    
+                total['year'][year][int(key[group] % 12 + 1)] = {
+                    'duration':timedelta(microseconds=int(self.duration[shift].sum())),
+                    'value':accumulate(self.value[shift]),
+                    'balance':float(balance[position[-1]]),
+                }
+        return total
+        
+    def ledger(self, start, end, renderer):
+        index = self.window(start, end)
+        balance = numpy.add.accumulate(numpy.concatenate(([0.0], self.signed[index])))[1:]
+        for position, event in enumerate(index):
+            if self.shift[event]:
+                yield (
+                    u'shift',
+                    renderer.stamp(int(self.round_start[event])),
+                    renderer.stamp(int(self.round_end[event])),
+                    unicode(timedelta(microseconds=int(self.round_duration[event]))),
+                    float(self.value[event]),
+                    float(balance[position]),
+                    self.comment(event)
+                )
+            else:
+                yield (
+                    u'payment',
+                    renderer.stamp(int(self.start[event])),
+                    '',
+                    '',
+                    float(self.value[event]),
+                    float(balance[position]),
+                    self.comment(event)
+                )
+                
+    def comment(self, index):
+        if self.records is not None:
+            return self.records.comment(index)
+        else:
+            return self.comments[index]
+            
+
+
+class Renderer(object):
+    def __init__(self, env, stream=None):
+        self.form = ('format' in env and env['format']) or 'table'
+        self.stream = stream
+        self.buffer = []
+        self.size = 0
+        self.dates = {}
+        
+    def render(self, kind, rows):
+        layout = render_format[kind]
+        self.emit(layout['fields'], expression[layout['header']], expression[layout['pattern']], rows)
+        
+    def emit(self, fields, header, pattern, rows):
+        if self.form == 'table':
+            self.write(header.format(*fields) + u'\n')
+            for row in rows:
+                self.write(pattern.format(*row) + u'\n')
+                
+        elif self.form == 'csv':
+            writer = csv.writer(self, lineterminator='\n')
+            writer.writerow([ field.encode('utf-8') for field in fields ])
+            for row in rows:
+                writer.writerow([ self.cell(value) for value in row ])
+                
+        elif self.form == 'tsv':
+            # tsv has no quoting, separators inside a value are blanked instead
+            self.write('\t'.join([ field.encode('utf-8') for field in fields ]) + '\n')
+            for row in rows:
+                self.write('\t'.join([ expression['tsv separator'].sub(' ', self.cell(value)) for value in row ]) + '\n')
+                
+        elif self.form == 'jsonl':
+            for row in rows:
+                record = {}
+                for field, value in zip(fields, row):
+                    if isinstance(value, float):
+                        value = round(value, 2)
+                    elif value == '':
+                        value = None
+                    record[field] = value
+                self.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + u'\n')
+        self.flush()
+        
+    def cell(self, value):
+        if value is None:
+            return ''
+        elif isinstance(value, float):
+            return '{:.2f}'.format(value)
+        elif isinstance(value, unicode):
+            return value.encode('utf-8')
+        else:
+            return str(value)
+            
+    def date(self, value):
+        # the same few dates recur through a ledger, each is formatted once
+        if value not in self.dates:
+            if len(self.dates) >= render_format['dates']:
+                self.dates.clear()
+            self.dates[value] = datetime.strftime(value, expression['csv datetime format'])
+        return self.dates[value]
+        
+    def stamp(self, microseconds):
+        if microseconds not in self.dates:
+            if len(self.dates) >= render_format['dates']:
+                self.dates.clear()
+            self.dates[microseconds] = datetime.strftime(microseconds_to_datetime(microseconds), expression['csv datetime format'])
+        return self.dates[microseconds]
+        
+    def write(self, text):
+        # also the file the csv writer writes to
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= render_format['buffer']:
+            self.flush()
+            
+    def flush(self):
+        if self.buffer:
+            (self.stream or sys.stdout).write(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+            
+
+
+class Output(object):
+    # print encodes unicode as ascii when stdout is not a terminal, rows with accented comments would fail in a pipe
+    def __init__(self, stream):
+        self.stream = stream
         
-    @property
-    def node(self):
-        result = {}
-        result['type'] = 'shift'
-        if self.start is not None:
-            result['start'] = datetime.strftime(self.start, expression['datetime format'])
-        if self.end is not None:
-            result['end'] = datetime.strftime(self.end, expression['datetime format'])
-        if self.precision is not None:
-            result['precision'] = int(self.precision.total_seconds())
-        if self.comment is not None:
-            result['comment'] = self.comment
-        if self.rate is not None:
-            result['rate'] = self.rate
-        return result
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.stream.write(text)
         
-    @property
-    def date(self):
-        return self.start
+    def flush(self):
+        self.stream.flush()
         
-    @property
-    def start(self):
-        if self._start is None and 'start' in self._node:
-            self._start = datetime.strptime(self._node['start'], expression['datetime format'])
-        return self._start
+    def fileno(self):
+        return self.stream.fileno()
         
-    @property
-    def end(self):
-        if self._end is None and 'end' in self._node:
-            self._end = datetime.strptime(self._node['end'], expression['datetime format'])
-        return self._end
+
+
+class Daemon(object):
+    def __init__(self, env):
+        self.log = logging.getLogger('daemon')
+        self.env = env
+        self.conf = expand_conf(env['conf'])
+        self.bill = None
+        self.server = None
+        self.first = None
+        self.last = None
         
-    @property
-    def precision(self):
-        if self._precision is None and 'precision' in self._node:
-            self._precision = timedelta(seconds=self._node['precision'])
-        return self._precision
+    def serve(self):
+        path = daemon_path(self.env)
+        if os.path.exists(path):
+            if forward_status(path):
+                self.log.error(u'A daemon is already listening on %s', path)
+                return
+            os.remove(path)
+            
+        self.bill = Bill(self.env)
+        if not self.bill.valid:
+            return
+        self.bill.batched = True
         
-    @property
-    def duration(self):
-        if self.running:
-            return datetime.now() - self.start
-        elif self.start is not None and self.end is not None:
-            return self.end - self.start
+        mask = os.umask(0o077)
+        try:
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+            self.server.listen(16)
+        finally:
+            os.umask(mask)
+            
+        signal.signal(signal.SIGTERM, lambda number, frame: sys.exit(0))
+        self.log.info(u'Serving %s on %s', self.conf, path)
+        try:
+            while True:
+                ready = select.select([ self.server ], [], [], self.timeout)[0]
+                if ready:
+                    connection = self.server.accept()[0]
+                    connection.settimeout(5)
+                    try:
+                        self.handle(connection)
+                    finally:
+                        connection.close()
+                        
+                if self.bill.pending and self.timeout == 0:
+                    self.settle()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.settle()
+            self.bill.unload()
+            self.server.close()
+            os.remove(path)
+            
+    def settle(self):
+        if self.bill.pending:
+            self.log.debug(u'Writing %d batched changes', len(self.bill.pending))
+            self.bill.settle()
+        self.first = None
+        self.last = None
+        
+    def handle(self, connection):
+        try:
+            request = []
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                request.append(chunk)
+            request = json.loads(''.join(request))
+        except (socket.error, ValueError) as err:
+            self.log.warning(u'Ignoring a malformed request')
+            self.log.debug(u'Exception raised %s', unicode(err))
         else:
-            return None
+            response = self.run(request['argv'], request['cwd'])
+            try:
+                connection.sendall(json.dumps(response))
+            except socket.error as err:
+                self.log.warning(u'Failed to answer a request')
+                self.log.debug(u'Exception raised %s', unicode(err))
             
-    @property
-    def rate(self):
-        if self._rate is None:
-            if 'rate' in self._node:
-                self._rate = self._node['rate']
+    def run(self, argv, cwd):
+        response = { 'refused':False, 'status':0, 'stdout':u'', 'stderr':u'' }
+        stdout, stderr = Capture(), Capture()
+        streams = sys.stdout, sys.stderr
+        root = logging.getLogger()
+        handlers = [ (handler, handler.stream) for handler in root.handlers if isinstance(handler, logging.StreamHandler) ]
+        level = root.level
+        sys.stdout, sys.stderr = stdout, stderr
+        for handler, stream in handlers:
+            handler.stream = stderr
+        try:
+            env = decode_cli(argv)
+            root.setLevel(log_levels[env['verbosity']])
+            
+            # paths on the command line are relative to the client
+            for key in ('conf', 'input', 'output'):
+                if key in env and env[key] != '-':
+                    env[key] = os.path.join(cwd, os.path.expanduser(env[key]))
+                    
+            
+            # only commands against the configuration this daemon holds are served
+            if env['action'] not in expression['daemon actions'] or expand_conf(env['conf']) != self.conf:
+                response['refused'] = True
+                
+            # standard input belongs to the client, a command reading it runs there
+            elif 'input' in env and env['input'] == '-':
+                response['refused'] = True
             else:
-                self._rate = self.project.config['rate']
-        return self._rate
+                self.bill.refresh()
+                self.bill.env = env
+                if self.bill.execute() is False and env['action'] in expression['status actions']:
+                    response['status'] = 1
+                if self.bill.pending:
+                    self.last = time.time()
+                    if self.first is None:
+                        self.first = self.last
+        except SystemExit as stop:
+            # argparse exits on --help and on bad arguments
+            response['status'] = stop.code if isinstance(stop.code, int) else 1
+        except Exception:
+            self.log.exception(u'Failed to serve %s', u' '.join(argv))
+            response['status'] = 1
+        finally:
+            sys.stdout, sys.stderr = streams
+            for handler, stream in handlers:
+                handler.stream = stream
+            root.setLevel(level)
             
-    @property
-    def value(self):
-        return round((float(self.round_duration.total_seconds()) / 3600.0),2) * self.rate
+        response['stdout'] = stdout.getvalue()
+        response['stderr'] = stderr.getvalue()
+        return response
         
     @property
-    def round_start(self):
-        if self.start is not None and self.precision is not None:
-            return round_datetime_to_timedelta(self.start, self.precision)
-        else:
+    def timeout(self):
+        # writes are debounced, but never held back longer than the limit
+        if self.first is None:
             return None
+        deadline = min(self.last + self.env['delay'], self.first + self.env['limit'])
+        return max(0.0, deadline - time.time())
+        
+
+
+class Capture(object):
+    def __init__(self):
+        self.buffer = []
+        
+    def write(self, text):
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        self.buffer.append(text)
+        
+    def flush(self):
+        pass
+        
+    def getvalue(self):
+        return u''.join(self.buffer)
+        
+
+
+class Profiler(object):
+    def __init__(self):
+        self.log = logging.getLogger('profile')
+        self.enabled = False
+        self.began = None
+        self.order = []
+        self.phases = {}
+        self.calls = {}
+        
+    def enable(self, helpers):
+        self.enabled = True
+        self.began = self.sample()
+        
+        # hot helpers are looked up in the module namespace on every call, so wrapping them there counts every caller
+        for name in helpers:
+            globals()[name] = self.counted(name, globals()[name])
             
+    def counted(self, name, function):
+        record = { 'calls':0, 'wall':0.0 }
+        self.calls[name] = record
+        def counter(*args, **kwargs):
+            record['calls'] += 1
+            began = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record['wall'] += time.time() - began
+        return counter
+        
+    def sample(self):
+        # python 2 has no allocation counter, the net change in objects tracked by the collector stands in for it
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            'wall':time.time(),
+            'cpu':usage.ru_utime + usage.ru_stime,
+            'rss':usage.ru_maxrss,
+            'objects':len(gc.get_objects()),
+        }
+        
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+        else:
+            began = self.sample()
+            try:
+                yield
+            finally:
+                ended = self.sample()
+                if name not in self.phases:
+                    self.order.append(name)
+                    self.phases[name] = { 'count':0, 'wall':0.0, 'cpu':0.0, 'rss':0, 'objects':0 }
+                record = self.phases[name]
+                record['count'] += 1
+                for key in ('wall', 'cpu', 'rss', 'objects'):
+                    record[key] += ended[key] - began[key]
+                    
     @property
-    def round_end(self):
-        if self.end is not None and self.precision is not None:
-            return round_datetime_to_timedelta(self.end, self.precision)
+    def summary(self):
+        ended = self.sample()
+        total = {}
+        for key in ('wall', 'cpu', 'rss', 'objects'):
+            total[key] = ended[key] - self.began[key]
+        return { 'total':total, 'phases':self.phases, 'order':self.order, 'calls':self.calls }
+        
+    def report(self, path):
+        summary = self.summary
+        if path is None:
+            # phases may nest, so their times can add up to more than the total
+            sys.stderr.write(expression['profile header'].format(u'phase', u'count', u'wall s', u'cpu s', u'rss KB', u'objects'))
+            for name in summary['order']:
+                record = summary['phases'][name]
+                sys.stderr.write(expression['profile pattern'].format(name, record['count'], record['wall'], record['cpu'], record['rss'], record['objects']))
+            total = summary['total']
+            sys.stderr.write(expression['profile pattern'].format(u'total', 1, total['wall'], total['cpu'], total['rss'], total['objects']))
+            
+            sys.stderr.write(expression['profile calls header'].format(u'helper', u'calls', u'wall s'))
+            for name in sorted(summary['calls']):
+                record = summary['calls'][name]
+                sys.stderr.write(expression['profile calls pattern'].format(name, record['calls'], record['wall']))
         else:
-            return None
+            try:
+                conf = open(path, 'w')
+                conf.write(json.dumps(summary, sort_keys=True, indent=4))
+                conf.close()
+            except IOError as ioerr:
+                self.log.warning(u'Failed to write profile to %s', path)
+                self.log.debug(u'Exception raised %s', unicode(ioerr))
+                
+profiler = Profiler()
+
+
+
+def decode_event(project, kind, start, end, precision, rate, amount, comment):
+    event = None
+    if kind == binary_format['type']['shift']:
+        # a new shift has neither a node nor derived values for Shift.__setattr__ to guard
+        event = Shift(project)
+        assign = object.__setattr__
+        if start is not None:
+            assign(event, '_start', expression['epoch'] + timedelta(microseconds=start))
+        if end is not None:
+            assign(event, '_end', expression['epoch'] + timedelta(microseconds=end))
+        if precision is not None:
+            assign(event, '_precision', timedelta(seconds=precision))
+        if rate is not None:
+            assign(event, '_rate', rate)
             
-    @property
-    def round_duration(self):
-        if self.running:
-            return round_datetime_to_timedelta(datetime.now(), self.precision) - self.start
-        elif self.round_start is not None and self.round_end is not None:
-            return self.round_end - self.round_start
+    elif kind == binary_format['type']['payment']:
+        event = Payment(project)
+        event._date = microseconds_to_datetime(start)
+        event._amount = amount
+        
+    if event is not None:
+        event._comment = comment
+    return event
+    
+def event_values(event):
+    # the fields decode_event takes, with times in epoch microseconds
+    values = [ binary_format['type']['none'], None, None, None, None, None, event.comment ]
+    if isinstance(event, Shift):
+        values[0] = binary_format['type']['shift']
+        if event.start is not None:
+            values[1] = datetime_to_microseconds(event.start)
+        if event.end is not None:
+            values[2] = datetime_to_microseconds(event.end)
+        if event.precision is not None:
+            values[3] = int(event.precision.total_seconds())
+        values[4] = event.rate
+        
+    elif isinstance(event, Payment):
+        values[0] = binary_format['type']['payment']
+        values[1] = datetime_to_microseconds(event.date)
+        values[5] = event.value
+    return values
+    
+def event_digest(name, values):
+    # an event is the same when project, type, times and amount are, whatever its comment or rate
+    kind, start, end, precision, rate, amount, comment = values
+    if amount is not None:
+        amount = repr(float(amount))
+    text = u'{}\x1f{}\x1f{}\x1f{}\x1f{}'.format(name, kind, start, end, amount)
+    digest = struct.unpack('<Q', hashlib.sha1(text.encode('utf-8')).digest()[:8])[0]
+    return digest or 1
+    
+def read_rows(path, kind):
+    # CSV with a header row or JSON Lines, fields named as in a database event
+    conf = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        if kind == 'csv':
+            reader = csv.reader(conf)
+            header = [ field.strip().lower() for field in next(reader, []) ]
+            for number, row in enumerate(reader, 2):
+                if row:
+                    yield import_values(dict(zip(header, [ value.decode('utf-8') for value in row ])), number)
         else:
+            for number, line in enumerate(conf, 1):
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError, valerr:
+                        raise ValueError(u'line {} is not JSON: {}'.format(number, unicode(valerr)))
+                    yield import_values(record, number)
+    finally:
+        if conf is not sys.stdin:
+            conf.close()
+            
+def import_values(record, number):
+    if not isinstance(record, dict):
+        raise ValueError(u'line {} is not an object'.format(number))
+        
+    def stamp(field):
+        value = record.get(field)
+        if value:
+            # strptime takes nothing but text
+            if isinstance(value, basestring):
+                for layout in import_format['dates']:
+                    try:
+                        return datetime_to_microseconds(datetime.strptime(value, layout))
+                    except ValueError:
+                        pass
+            raise ValueError(u'line {} has an unreadable {} {}'.format(number, field, value))
+        return None
+        
+    def number_of(field, convert):
+        value = record.get(field)
+        if value is None or value == u'':
             return None
+        try:
+            return convert(value)
+        except (TypeError, ValueError):
+            raise ValueError(u'line {} has an unreadable {} {}'.format(number, field, value))
             
-    @property
-    def order(self):
-        return self.start
+    kind = record.get('type')
+    comment = record.get('comment') or None
+    if comment is not None and not isinstance(comment, basestring):
+        raise ValueError(u'line {} has an unreadable comment {}'.format(number, comment))
         
-
-
-class Payment(Event):
-    def __init__(self, project, node={}):
-        Event.__init__(self, project, node)
-        self._date = None
+    if kind == 'shift':
+        start, end = stamp('start'), stamp('end')
+        if start is None or end is None:
+            raise ValueError(u'line {} is a shift without a start and an end'.format(number))
+        precision = number_of('precision', int)
+        if precision is None:
+            precision = import_format['precision']
+        rate = record.get('rate')
+        if not isinstance(rate, (int, long, float)):
+            rate = number_of('rate', float)
+        return (binary_format['type']['shift'], start, end, precision, rate, None, comment)
         
-    @property
-    def node(self):
-        result = {}
-        result['type'] = 'payment'
-        result['amount'] = self.value
-        result['date'] = datetime.strftime(self.date, expression['datetime format'])
-        if self.comment is not None:
-            result['comment'] = self.comment
-        return result
+    elif kind == 'payment':
+        # a balance sheet keeps the date of a payment in its start column
+        date = stamp('date') if record.get('date') else stamp('start')
+        amount = number_of('amount', float)
+        if date is None or amount is None:
+            raise ValueError(u'line {} is a payment without a date and an amount'.format(number))
+        return (binary_format['type']['payment'], date, None, None, None, amount, comment)
         
-    def print_balance(self):
-        print expression['csv record pattern'].format (
-            self.type,
-            datetime.strftime(self.date, expression['csv datetime format']),
-            '',
-            '',
-            self.value,
-            self.balance,
-            self.comment
-        )
+    raise ValueError(u'line {} has an unknown type {}'.format(number, kind))
+    
+def merge_events(history, events):
+    # both in order, an event already recorded comes before a new one at the same time
+    merged = []
+    position = 0
+    for event in events:
+        while position < len(history) and history[position].order <= event.order:
+            merged.append(history[position])
+            position += 1
+        merged.append(event)
+    merged.extend(history[position:])
+    return merged
+    
+def expand_conf(path):
+    return os.path.realpath(os.path.expanduser(os.path.expandvars(path)))
+    
+def daemon_path(env=None):
+    if env is not None and 'socket' in env:
+        return expand_conf(env['socket'])
+    return expand_conf(os.environ.get('BILL_SOCKET', expression['daemon socket']))
+    
+def forward_status(path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        return False
+    else:
+        return True
+    finally:
+        client.close()
         
-    def report(self):
-        print expression['csv record pattern'].format (
-            datetime.strftime(self.date, expression['csv datetime format']),
-            '',
-            '',
-            self.value,
-            self.balance
-        )
+def forward(argv):
+    # a running daemon answers from memory, without one the command runs in this process
+    result = None
+    path = daemon_path()
+    if os.path.exists(path):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(path)
+            client.sendall(json.dumps({ 'argv':argv, 'cwd':os.getcwd() }))
+            client.shutdown(socket.SHUT_WR)
+            reply = []
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                reply.append(chunk)
+        except socket.error:
+            pass
+        else:
+            try:
+                response = json.loads(''.join(reply))
+            except ValueError:
+                pass
+            else:
+                if not response['refused']:
+                    sys.stdout.write(response['stdout'].encode('utf-8'))
+                    sys.stderr.write(response['stderr'].encode('utf-8'))
+                    result = response['status']
+        finally:
+            client.close()
+    return result
+    
+def aggregate_project(task):
+    env, name, action, start, end = task
+    bill = Bill(env)
+    project = bill.project[name]
+    if action == 'monthly':
+        total = project.breakdown(start, end)
+    else:
+        total = project.aggregate(start, end)
+    running = project.running
+    bill.unload()
+    return name, total, running
+    
+def summarize_events(events, start, end, opening=0.0):
+    total = {
+        'duration':timedelta(),
+        'shift':0,
+        'payment':0,
+        'early':None,
+        'late':None,
+        'labour':0.0,
+        'deposit':0.0,
+        'balance':0.0,
+        'opening':None,
+    }
+    if start is not None:
+        total['opening'] = opening
         
-    @property
-    def date(self):
-        if self._date is None and 'date' in self._node:
-            self._date = datetime.strptime(self._node['date'], expression['datetime format'])
-        return self._date
+    # events before the window only carry their balance into it
+    for event in events:
+        if isinstance(event, Shift):
+            if (start is None or event.round_start > start) \
+            and (end is None or event.round_start < end):
+                if total['early'] is None or event.round_start < total['early']:
+                    total['early'] =  event.round_start
+                    
+                if total['late'] is None or event.round_end > total['late']:
+                    total['late'] =  event.round_end
+                    
+                # update totals
+                total['duration'] += event.round_duration
+                total['shift'] += 1
+                total['labour'] += event.value
+                total['balance'] += event.value
+                event.balance = total['balance']
+                
+            elif start is not None and event.round_start <= start:
+                total['opening'] += event.value
+                
+        elif isinstance(event, Payment):
+            if (start is None or event.date > start) \
+            and (end is None or event.date < end):
+                if total['early'] is None or event.date < total['early']:
+                    total['early'] =  event.date
+                    
+                if total['late'] is None or event.date > total['late']:
+                    total['late'] =  event.date
+                    
+                # update totals
+                total['payment'] += 1
+                total['deposit'] += event.value
+                total['balance'] -= event.value
+                event.balance = total['balance']
+                
+            elif start is not None and event.date <= start:
+                total['opening'] -= event.value
+                
+    return total
+    
+def merge_report(grand, total):
+    if grand is None:
+        grand = {
+            'duration':timedelta(),
+            'shift':0,
+            'payment':0,
+            'early':None,
+            'late':None,
+            'labour':0.0,
+            'deposit':0.0,
+            'balance':0.0,
+            'opening':None,
+        }
+    for key in ('duration', 'shift', 'payment', 'labour', 'deposit', 'balance'):
+        grand[key] += total[key]
         
-    @property
-    def value(self):
-        return self._node['amount']
+    if total['opening'] is not None:
+        grand['opening'] = (grand['opening'] or 0.0) + total['opening']
         
-    @property
-    def order(self):
-        return self.date
+    if total['early'] is not None and (grand['early'] is None or total['early'] < grand['early']):
+        grand['early'] = total['early']
         
-
-
+    if total['late'] is not None and (grand['late'] is None or total['late'] > grand['late']):
+        grand['late'] = total['late']
+    return grand
+    
+def merge_monthly(grand, name, total):
+    if grand is None:
+        grand = {
+            'balance':0.0,
+            'year':{},
+        }
+    for year, months in total['year'].iteritems():
+        for month, record in months.iteritems():
+            if year not in grand['year']:
+                grand['year'][year] = {}
+                
+            if month not in grand['year'][year]:
+                grand['year'][year][month] = {
+                    'duration':timedelta(),
+                    'value':0.0,
+                    'balance':None,
+                    'projects':{},
+                }
+            merged = grand['year'][year][month]
+            merged['duration'] += record['duration']
+            merged['value'] += record['value']
+            if record['balance'] is not None:
+                merged['projects'][name] = record['balance']
+                
+    # a project without events in a month still owes the balance it closed the previous month with
+    balance = {}
+    for year in sorted(grand['year'].keys()):
+        for month in sorted(grand['year'][year].keys()):
+            merged = grand['year'][year][month]
+            balance.update(merged['projects'])
+            merged['balance'] = sum(balance.values())
+    grand['balance'] = sum(balance.values())
+    return grand
+    
+def group_events(events, start, end, keys, metrics):
+    # history arrives in event order, so a leading time key comes in contiguous runs that are done with once the key moves on
+    cardinality, ordered = aggregate_format['key'][keys[0]]
+    ordered = ordered and cardinality >= aggregate_format['runs']
+    table = {}
+    run = None
+    balance = 0.0
+    for event in events:
+        if event.date:
+            if (start is None or event.date > start) and (end is None or event.date < end):
+                if isinstance(event, Shift):
+                    balance += event.value
+                elif isinstance(event, Payment):
+                    balance -= event.value
+                else:
+                    continue
+                    
+                for key in group_keys(event, keys):
+                    if ordered and key[0] != run:
+                        for row in group_rows(table, metrics):
+                            yield row
+                        table = {}
+                        run = key[0]
+                        
+                    if key not in table:
+                        table[key] = {
+                            'duration':timedelta(),
+                            'value':0.0,
+                            'count':0,
+                            'balance':None,
+                        }
+                    record = table[key]
+                    
+                    # update totals
+                    if isinstance(event, Shift):
+                        record['duration'] += event.duration
+                        record['value'] += event.value
+                    record['count'] += 1
+                    record['balance'] = balance
+                    
+    for row in group_rows(table, metrics):
+        yield row
+        
+def group_keys(event, keys):
+    # a shift tagged several times is counted once under each of its tags
+    key = [ () ]
+    for name in keys:
+        date = event.date
+        if name == 'day':
+            values = [ u'{:04}-{:02}-{:02}'.format(date.year, date.month, date.day) ]
+        elif name == 'week':
+            year, week, day = date.isocalendar()
+            values = [ u'{:04}-W{:02}'.format(year, week) ]
+        elif name == 'month':
+            values = [ u'{:04}-{:02}'.format(date.year, date.month) ]
+        elif name == 'year':
+            values = [ date.year ]
+        elif name == 'rate':
+            # backends differ in whether a rate comes back an int or a float
+            values = [ float(event.rate) if isinstance(event, Shift) and event.rate is not None else None ]
+        elif name == 'tag':
+            values = (event.comment and sorted(set(aggregate_format['tag'].findall(event.comment)))) or [ None ]
+        key = [ prefix + (value,) for prefix in key for value in values ]
+    return key
+    
+def group_rows(table, metrics):
+    for key in sorted(table.keys()):
+        record = table[key]
+        row = [ u'' if value is None else value for value in key ]
+        for metric in metrics:
+            if metric == 'hours':
+                row.append(round((float(record['duration'].total_seconds()) / 3600.0),2))
+            else:
+                row.append(record[metric])
+        yield row
+        
+def print_report(name, total):
+    total['hours'] = total['duration'].total_seconds() / 3600.0
+    print u'{:<10}: {}'.format('Name', name)
+    print u'{:<10}: {}'.format('From', total['early'])
+    print u'{:<10}: {}'.format('To', total['late'])
+    print u'{:<10}: {}'.format('Payments', total['payment'])
+    print u'{:<10}: {}'.format('Shifts', total['shift'])
+    print u'{:<10}: {:.2f} hours'.format('Work', total['hours'])
+    if total['opening'] is not None:
+        print u'{:<10}: {:.2f}$'.format('Opening', total['opening'])
+    print u'{:<10}: {:.2f}$'.format('Labour', total['labour'])
+    print u'{:<10}: {:.2f}$'.format('Deposit', total['deposit'])
+    print u'{:<10}: {:.2f}$'.format('Balance', total['balance'])
+    
+def print_running(start, duration, comment):
+    print expression['current record pattern'].format (
+        datetime.strftime(start, expression['csv datetime format']),
+        unicode(duration),
+    )
+    if comment:
+        print comment
+        
+def project_balance_row(name, total):
+    return (
+        name,
+        total['shift'],
+        total['payment'],
+        round((float(total['duration'].total_seconds()) / 3600.0),2),
+        total['labour'],
+        total['deposit'],
+        total['balance'],
+    )
+    
+def project_monthly_rows(name, total):
+    for year in sorted(total['year'].keys()):
+        for month in sorted(total['year'][year].keys()):
+            record = total['year'][year][month]
+            yield (
+                name,
+                year,
+                month,
+                round((float(record['duration'].total_seconds()) / 3600.0),2),
+                record['value'],
+                record['balance']
+            )
+            
 def default_json_handler(o):
     result = None
     if isinstance(o, datetime):
         result = datetime.strftime(o, expression['datetime format'])
     return result
     
+def parse_datetime(value):
+    return datetime.strptime(value, expression['datetime format'])
+    
 def parse_time_delta(delta):
     result = None
     if delta is None:
@@ -682,26 +4733,96 @@ def parse_time_delta(delta):
     return result
     
 def round_datetime_to_timedelta(time, quantizer):
-    def datetime_to_seconds(time):
-        delta = time - expression['epoch']
-        return delta.total_seconds()
-        
-    stamp = datetime_to_seconds(time)
-    quant = quantizer.total_seconds()
-    result = int(stamp / quant)
-    remain = stamp - result * quant
-    if int(round(remain/quant)): result += 1
-    return datetime.utcfromtimestamp(result * quant)
-    
-def decode_cli():
+    delta = time - expression['epoch']
+    stamp = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    quant = (quantizer.days * 86400 + quantizer.seconds) * 1000000 + quantizer.microseconds
+    return expression['epoch'] + timedelta(microseconds=round_microseconds(stamp, quant))
+    
+def round_microseconds(stamp, quant):
+    # the quotient is truncated like int() and moves up one quant from half of one on, as the float seconds once did,
+    # a zero quant leaves the stamp as it is
+    if quant == 0:
+        return stamp
+    result = abs(stamp) // abs(quant)
+    if (stamp < 0) != (quant < 0):
+        result = -result
+    if 2 * abs(stamp - result * quant) >= abs(quant):
+        result += 1
+    return result * quant
+    
+def load_numpy():
+    # imported on first use, a client handing its command to the daemon never needs it
+    global numpy, numpy_loaded
+    if not numpy_loaded:
+        numpy_loaded = True
+        try:
+            import numpy as module
+        except ImportError:
+            pass
+        else:
+            numpy = module
+    return numpy
+    
+def round_stamps(stamps, quant):
+    # a whole sequence at once, quant is one for all of them or one per stamp
+    if load_numpy() is not None:
+        return round_column(numpy.asarray(stamps, dtype=numpy.int64), numpy.asarray(quant, dtype=numpy.int64)).tolist()
+    if isinstance(quant, (int, long)):
+        return [ round_microseconds(stamp, quant) for stamp in stamps ]
+    return [ round_microseconds(stamp, q) for stamp, q in zip(stamps, quant) ]
+    
+def delta_to_microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    
+def datetime_to_microseconds(time):
+    return delta_to_microseconds(time - expression['epoch'])
+    
+def microseconds_to_datetime(stamp):
+    return expression['epoch'] + timedelta(microseconds=int(stamp))
+    
+def round_column(stamp, quant):
+    # round_microseconds over int64 columns of microseconds
+    step = numpy.absolute(quant)
+    divisor = numpy.where(step == 0, 1, step)
+    result = numpy.absolute(stamp) // divisor * numpy.where((stamp < 0) != (quant < 0), -1, 1)
+    result += 2 * numpy.absolute(stamp - result * quant) >= step
+    return numpy.where(step == 0, stamp, result * quant)
+    
+def hours_column(duration):
+    # round() per distinct duration keeps the value identical to Shift.value
+    distinct, inverse = numpy.unique(duration, return_inverse=True)
+    hours = numpy.array([ round((float(d) / 1e6 / 3600.0), 2) for d in distinct ], dtype=numpy.float64)
+    return hours[inverse]
+    
+def accumulate(column):
+    # a left to right running sum from 0.0, so the result matches the event loop to the bit
+    return float(numpy.add.accumulate(numpy.concatenate(([0.0], column)))[-1])
+    
+def decode_cli(argv=None, parser=None):
     env = {}
+    if parser is None:
+        parser = command_parser()
+        
+    for k,v in vars(parser.parse_args(argv)).iteritems():
+        if v is not None:
+            env[k] = v
+    return env
     
+def command_parser():
     # -- global arguments for all actions --
     p = ArgumentParser()
     p.add_argument('-v', '--verbosity', metavar='LEVEL', dest='verbosity', default='info',                help='logging verbosity level [default: %(default)s]', choices=log_levels.keys())
     p.add_argument('-c', '--conf',      metavar='PATH',  dest='conf',      default='~/.bill/config.json', help='Path to configuration file [default: %(default)s]')
     p.add_argument('-p', '--project',                    dest='project',   default='wrd',                 help='project to bill')
     p.add_argument('-s', '--sort',                       dest='sort',      action='store_true')
+    p.add_argument('--columnar',                         dest='columnar',  action='store_true',            help='compute reports over NumPy columns when available')
+    p.add_argument('--stream',                           dest='stream',    action='store_true',            help='decode a sorted JSON history while reading it, in constant memory')
+    p.add_argument('--format',          metavar='FORMAT', dest='format',   default='table', choices=['table', 'csv', 'tsv', 'jsonl'], help='balance and monthly output format [default: %(default)s]')
+    p.add_argument('-a', '--all',                        dest='all',       action='store_true',            help='report, balance and monthly over every configured project, -p also takes a glob')
+    p.add_argument('-j', '--jobs',      metavar='N',     dest='jobs',      type=int,                       help='processes aggregating projects in parallel [default: number of cores]')
+    p.add_argument('--profile',                          dest='profile',   action='store_true',            help='report wall time, CPU time and allocations per phase on stderr')
+    p.add_argument('--profile-output',  metavar='PATH',  dest='profile_output',                            help='write the profile as JSON to PATH instead, implies --profile')
+    p.add_argument('--profile-dump',    metavar='PATH',  dest='profile_dump',                              help='also write cProfile statistics to PATH, implies --profile')
     
     # application version
     p.add_argument('--version', action='version', version='%(prog)s 0.1')
@@ -729,6 +4850,29 @@ def decode_cli():
     c.add_argument('-m', '--amount', metavar='AMOUNT', type=float, dest='amount',   help='Amount of payment')
     c.add_argument('-d', '--date',   metavar='DATE', dest='date',   help='Date of payment')
     
+    c = s.add_parser( 'export', help='export project database',
+        description='Write the project database as JSON, whatever its storage format.'
+    )
+    c.add_argument('-o', '--output', metavar='PATH', dest='output', default='-', help='Path to write to [default: stdout]')
+    
+    c = s.add_parser( 'import', help='import project database or append events in bulk',
+        description='Replace the project database with a JSON database, stored in the configured format. A CSV file with a header row, or JSON Lines, is appended to the project instead, fields are named as in a database event. Events already recorded with the same type, times and amount are skipped.'
+    )
+    c.add_argument('-i', '--input',  metavar='PATH', dest='input', required=True, help='Path of JSON database, CSV or JSON Lines to read')
+    c.add_argument('-t', '--type',   metavar='TYPE', dest='type',  choices=['json', 'csv', 'jsonl'], help='input type [default: by extension, .csv, .jsonl or else json]')
+    c.add_argument('-b', '--budget', metavar='ROWS', dest='budget', type=int, help='rows sorted and merged at a time [default: {}]'.format(import_format['budget']))
+    
+    c = s.add_parser( 'batch', help='apply many commands with one load and one write',
+        description='Every line of PATH is a start, stop, pay or import command with its arguments, as it would be given on the command line, and may pick its project with -p. Blank lines and # comments are skipped. Each project is written once after the last line, nothing is written if any line fails.'
+    )
+    c.add_argument('-i', '--input',  metavar='PATH', dest='input', default='-', help='Path of commands to read [default: stdin]')
+    
+    c = s.add_parser( 'migrate', help='copy project database to another location',
+        description='Copy the project database, with its running shift, to an empty database at LOCATION. LOCATION is a path or a URL, shard:///path/to/directory keeps one file per month or year. Point the project at LOCATION once it is done.'
+    )
+    c.add_argument('-o', '--output', metavar='LOCATION', dest='output', required=True, help='database to write')
+    c.add_argument('--shard', metavar='PERIOD', dest='shard', choices=['month', 'year'], help='period of a shard:// database [default: month]')
+    
     c = s.add_parser( 'report', help='report hours',
         description='DATE is given as YYYY-MM-DD.'
     )
@@ -747,39 +4891,67 @@ def decode_cli():
     c.add_argument('-f', '--from', metavar='DATE', dest='from', help='Earliest time to start report')
     c.add_argument('-t', '--to',   metavar='DATE', dest='to',   help='Latest time to report')
     
-    for k,v in vars(p.parse_args()).iteritems():
-        if v is not None:
-            env[k] = v
-    return env
+    c = s.add_parser( 'aggregate', help='totals grouped by several keys at once',
+        description='Totals for every combination of the KEY values, taken in one pass over the history. KEY is day, week, month, year, rate or tag, a tag is a #word in a comment. METRIC is hours, value, count or balance. DATE is given as YYYY-MM-DD.'
+    )
+    c.add_argument('-g', '--group',  metavar='KEY',    dest='group',  nargs='+', default=['month'], choices=sorted(aggregate_format['key'].keys()), help='keys to group by, in order [default: month]')
+    c.add_argument('-m', '--metric', metavar='METRIC', dest='metric', nargs='+', default=list(aggregate_format['metric']), choices=aggregate_format['metric'], help='metrics to total [default: all of them]')
+    c.add_argument('-f', '--from',   metavar='DATE',   dest='from',   help='Earliest time to start report')
+    c.add_argument('-t', '--to',     metavar='DATE',   dest='to',     help='Latest time to report')
+    
+    c = s.add_parser( 'serve', help='keep the bill in memory and serve commands over a unix socket',
+        description='Commands run as usual are sent to the daemon when one is listening on $BILL_SOCKET, or ~/.bill/bill.sock.'
+    )
+    c.add_argument('-S', '--socket', metavar='PATH',    dest='socket', help='socket to listen on [default: $BILL_SOCKET or ~/.bill/bill.sock]')
+    c.add_argument('-d', '--delay',  metavar='SECONDS', dest='delay',  default=0.5, type=float, help='write changes once no request came for this long [default: %(default)s]')
+    c.add_argument('-l', '--limit',  metavar='SECONDS', dest='limit',  default=5.0, type=float, help='write changes at the latest this long after the first [default: %(default)s]')
+    
+    return p
+    
+def execute(env):
+    result = True
+    if env['action'] == 'serve':
+        Daemon(env).serve()
+    else:
+        bill = Bill(env)
+        if bill.valid:
+            # a bulk load or a batch that failed, even in part, shows in the exit status
+            if bill.execute() is False and env['action'] in expression['status actions']:
+                result = False
+            bill.unload()
+    return result
     
 def main():
     logging.basicConfig()
     logging.getLogger().setLevel(logging.DEBUG)
     
+    # profiled runs and the daemon itself are never forwarded
+    argv = sys.argv[1:]
+    if 'serve' not in argv and not [ a for a in argv if a.startswith('--profile') ]:
+        status = forward(argv)
+        if status is not None:
+            sys.exit(status)
+            
+    if sys.stdout.encoding is None:
+        sys.stdout = Output(sys.stdout)
+        
     env = decode_cli()
     logging.getLogger().setLevel(log_levels[env['verbosity']])
-    bill = Bill(env)
-    bill.load()
-    if bill.valid:
-        if env['action'] == 'start':
-            bill.start(env['project'])
+    if env['profile'] or 'profile_output' in env or 'profile_dump' in env:
+        profiler.enable(('round_datetime_to_timedelta', 'parse_time_delta', 'parse_datetime', 'decode_event', 'microseconds_to_datetime'))
+        if 'profile_dump' in env:
+            trace = cProfile.Profile()
+            result = trace.runcall(execute, env)
+            trace.dump_stats(env['profile_dump'])
+        else:
+            result = execute(env)
+        profiler.report(env['profile_output'] if 'profile_output' in env else None)
+    else:
+        result = execute(env)
+        
+    # a failed batch is reported to the script that ran it
+    if not result:
+        sys.exit(1)
         
-        if env['action'] == 'stop':
-            bill.stop(env['project'])
-            
-        if env['action'] == 'pay':
-            bill.pay(env['project'])
-            
-        if env['action'] == 'report':
-            bill.report(env['project'])
-            
-        if env['action'] == 'balance':
-            bill.balance(env['project'])
-            
-        if env['action'] == 'monthly':
-            bill.monthly(env['project'])
-            
-    bill.unload()
-    
 if __name__ == '__main__':
     main()